@@ -0,0 +1,871 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import resource
+import json
+import gc
+
+from lex import tokenize
+from parse import parse
+from function import basic_environment, evaluate, set_evaluator, module_cache
+from datatypes import Environment, LispPair, LispLambda, nil, make_integer, from_list, mksym
+import compiler
+import machine
+import formcache
+from image import save_image, load_image
+from profiler import Profiler, Sampler
+import counters
+import datatypes
+
+# -----------------------------------------------------------------------------
+# Benchmarks
+#
+# Time some lisp code under each of the evaluators. Each benchmark has some
+# setup code (run once) and an expression which is timed.
+# -----------------------------------------------------------------------------
+
+def run_code(code, env):
+    result = None
+    for sexp in parse(tokenize([code])):
+        result = evaluate(sexp, env)
+    return result
+
+def time_code(setup, code, evaluator, repeat=5):
+    # time_code :: Str -> Str -> Str -> Int -> (Float, Str)
+    # returns the best time of `repeat` runs and the result
+    set_evaluator(evaluator)
+    try:
+        env = Environment([], [], basic_environment)
+        run_code(setup, env)
+        return time_runs(code, env, repeat)
+    finally:
+        set_evaluator("tree")
+
+def time_runs(code, env, repeat):
+    # time_runs :: Str -> Environment -> Int -> (Float, Str)
+    # the same, in an environment that is already set up
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = run_code(code, env)
+        taken = time.time() - start
+        if best is None or taken < best:
+            best = taken
+    return best, str(result)
+
+# -----------------------------------------------------------------------------
+
+factorial = """
+(define (factorial n)
+  (if (= n 0)
+    1
+    (* n (factorial (- n 1)))))
+"""
+
+fibonacci = """
+(define (fib n)
+  (if (< n 2)
+    n
+    (+ (fib (- n 1)) (fib (- n 2)))))
+"""
+
+benchmarks = [
+    ("factorial", factorial, "(factorial 20)"),
+    ("fibonacci", fibonacci, "(fib 12)")]
+
+def compare_evaluators(evaluators=("tree", "compile", "machine")):
+    for name, setup, code in benchmarks:
+        times = []
+        for evaluator in evaluators:
+            taken, result = time_code(setup, code, evaluator)
+            times.append(taken)
+            print "%-12s %-8s %8.4fs %6.2fx  %s" % (
+                name, evaluator, taken, times[0] / taken, result)
+
+# -----------------------------------------------------------------------------
+# Looking up globals from deep in a recursion
+#
+# `down-a` and `down-b` recurse to `depth` (with different parameter names so
+# their frames all stay alive) then `count` loops, looking up the globals `=`,
+# `+` and `count` each time round. The time per loop should not depend on 
+# the depth.
+# -----------------------------------------------------------------------------
+
+deep = """
+(define (down-a a) (if (= a 0) (count 0 %d) (+ 0 (down-b (- a 1)))))
+(define (down-b b) (if (= b 0) (count 0 %d) (+ 0 (down-a (- b 1)))))
+(define (count i n) (if (= i n) i (count (+ i 1) n)))
+"""
+
+def lookup_depth(evaluators=("tree", "compile", "machine"), 
+                 depths=(10, 100, 1000), iterations=20000):
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        for evaluator in evaluators:
+            for depth in depths:
+                setup = deep % (iterations, iterations)
+                taken, result = time_code(setup, "(down-a %d)" % depth, evaluator, 1)
+                print "%-12s %-8s depth %5d %8.2fus per loop" % (
+                    "lookup", evaluator, depth, 1e6 * taken / iterations)
+    finally:
+        sys.setrecursionlimit(limit)
+
+# -----------------------------------------------------------------------------
+# Free variables and scope
+#
+# As above, but the loop also reads `step`, which is a parameter name too so
+# it cannot be cached. With dynamic scope finding it walks the frames of the
+# whole recursion, with lexical scope only the loop's frame and its closure.
+# -----------------------------------------------------------------------------
+
+free = """
+(define step 1)
+(define (use-step step) step)
+(define (down-a a) (if (= a 0) (count 0 %d) (+ 0 (down-b (- a 1)))))
+(define (down-b b) (if (= b 0) (count 0 %d) (+ 0 (down-a (- b 1)))))
+(define (count i n) (if (= i n) i (count (+ i step) n)))
+"""
+
+def scope_depth(evaluators=("tree", "compile", "machine"),
+                depths=(10, 100, 1000), iterations=2000):
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        for dynamic in (True, False):
+            datatypes.dynamic_scope = dynamic
+            scope = "dynamic" if dynamic else "lexical"
+            for evaluator in evaluators:
+                for depth in depths:
+                    setup = free % (iterations, iterations)
+                    taken, result = time_code(setup, "(down-a %d)" % depth, evaluator, 1)
+                    print "%-12s %-8s depth %5d %8.2fus per loop" % (
+                        scope, evaluator, depth, 1e6 * taken / iterations)
+    finally:
+        datatypes.dynamic_scope = False
+        sys.setrecursionlimit(limit)
+
+# -----------------------------------------------------------------------------
+# Tokenizing big files
+#
+# prelude.scm repeated to make files of a few MB. The time per MB should stay
+# the same as the files get bigger, and the memory used should not grow.
+# -----------------------------------------------------------------------------
+
+def tokenize_size(sizes=(1, 4, 16)):
+    source = open("prelude.scm").read()
+    for size in sizes:
+        handle, path = tempfile.mkstemp(suffix=".scm")
+        try:
+            with os.fdopen(handle, "w") as stream:
+                for i in range(size * 2**20 // len(source) + 1):
+                    stream.write(source)
+
+            start = time.time()
+            count = 0
+            for token in tokenize(open(path)):
+                count += 1
+            taken = time.time() - start
+            print "%-12s %5dMB %9d tokens %8.2fs %8.2fs per MB" % (
+                "tokenize", size, count, taken, taken / size)
+        finally:
+            os.remove(path)
+
+# -----------------------------------------------------------------------------
+# Parsing long lists
+#
+# A quoted list of `length` numbers, the time per element should not grow.
+# -----------------------------------------------------------------------------
+
+def parse_length(lengths=(10000, 100000, 1000000)):
+    for length in lengths:
+        code = "'(" + " ".join(str(n % 1000) for n in xrange(length)) + ")"
+        start = time.time()
+        sexps = list(parse(tokenize(code)))
+        taken = time.time() - start
+        print "%-12s %8d elements %8.2fs %8.2fus per element" % (
+            "parse", length, taken, 1e6 * taken / length)
+
+# -----------------------------------------------------------------------------
+# Loading with the form cache
+#
+# Reading the forms of a big library (prelude.scm repeated) with no cache,
+# the first time (cold, it parses then writes the cache) and after that
+# (warm, only the cache is read).
+# -----------------------------------------------------------------------------
+
+def form_cache(size=4):
+    source = open("prelude.scm").read()
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "library.scm")
+    try:
+        with open(path, "w") as stream:
+            for i in range(size * 2**20 // len(source) + 1):
+                stream.write(source)
+
+        for name in ["uncached", "cold", "warm"]:
+            formcache.enabled = name != "uncached"
+            start = time.time()
+            sexps = formcache.read_forms(path)
+            taken = time.time() - start
+            print "%-12s %-8s %5dMB %6d forms %8.2fs" % (
+                "form cache", name, size, len(sexps), taken)
+    finally:
+        formcache.enabled = True
+        shutil.rmtree(directory)
+
+# -----------------------------------------------------------------------------
+# Starting from an image
+#
+# An environment with the prelude included, made by evaluating prelude.scm
+# (with its forms already cached) or by loading an image of it.
+# -----------------------------------------------------------------------------
+
+def image_startup(repeat=5):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "prelude.image")
+    stdout = sys.stdout
+    try:
+        # the prelude displays its progress
+        sys.stdout = open(os.devnull, "w")
+        include, load = None, None
+        for i in range(repeat):
+            start = time.time()
+            env = Environment([], [], basic_environment)
+            run_code('(include "prelude.scm")', env)
+            taken = time.time() - start
+            include = taken if include is None else min(include, taken)
+
+            save_image(env, path)
+            start = time.time()
+            load_image(path)
+            taken = time.time() - start
+            load = taken if load is None else min(load, taken)
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(directory)
+
+    print "%-12s %-8s %8.4fs" % ("startup", "include", include)
+    print "%-12s %-8s %8.4fs %6.2fx" % ("startup", "image", load, include / load)
+
+# -----------------------------------------------------------------------------
+# Macros in a loop
+#
+# The same loop written with `let` and `when` and with them expanded by hand.
+# Each use of a macro should only be expanded the first time round.
+# -----------------------------------------------------------------------------
+
+macro_loops = """
+(define (loop-mac i n acc)
+  (if (= i n)
+    acc
+    (let ((j (+ i 1)))
+      (when (< i n) (loop-mac j n (+ acc 1))))))
+
+(define (loop-hand i n acc)
+  (if (= i n)
+    acc
+    ((lambda (j)
+       (if (< i n) (begin (loop-hand j n (+ acc 1))) nil))
+     (+ i 1))))
+"""
+
+def macro_loop(evaluators=("tree", "compile", "machine"), iterations=20000):
+    for evaluator in evaluators:
+        times = []
+        for name in ["loop-hand", "loop-mac"]:
+            code = "(%s 0 %d 0)" % (name, iterations)
+            taken, result = time_code(macro_loops, code, evaluator, 3)
+            times.append(taken)
+            print "%-12s %-8s %-9s %8.2fus per loop %6.2fx" % (
+                "macro", evaluator, name, 1e6 * taken / iterations, taken / times[0])
+
+# -----------------------------------------------------------------------------
+# Summing
+#
+# A list summed with foldl (a call to + per element) and with apply (one
+# call), then a loop adding four numbers with nested and with one call to +.
+# -----------------------------------------------------------------------------
+
+summing = """
+(define (range-from i n acc) (if (= i n) acc (range-from (+ i 1) n (cons i acc))))
+(define big (range-from 0 %d nil))
+
+(define (sum-nested i n acc)
+  (if (= i n) acc (sum-nested (+ i 1) n (+ acc (+ i (+ i i))))))
+(define (sum-flat i n acc)
+  (if (= i n) acc (sum-flat (+ i 1) n (+ acc i i i))))
+"""
+
+def variadic_sum(evaluators=("tree", "compile", "machine"), size=10000):
+    for evaluator in evaluators:
+        for name, code in [("foldl"   , "(foldl + 0 big)"),
+                           ("apply"   , "(apply + big)"),
+                           ("nested"  , "(sum-nested 0 %d 0)" % size),
+                           ("flat"    , "(sum-flat 0 %d 0)" % size)]:
+            taken, result = time_code(summing % size, code, evaluator, 3)
+            print "%-12s %-8s %-8s %8.2fus per element  %s" % (
+                "sum", evaluator, name, 1e6 * taken / size, result)
+
+# -----------------------------------------------------------------------------
+# Summing a vector
+#
+# A million integers summed with vector-sum, and as a list with foldl (a
+# tenth as many, it takes too long otherwise) and apply. Also the time to
+# convert the list to a vector and back.
+# -----------------------------------------------------------------------------
+
+def vector_sum(size=1000000, repeat=3):
+    env = Environment([], [], basic_environment)
+    nums = range(size)
+    env.define("big", None, from_list(map(make_integer, nums) + [nil]))
+    env.define("small", None, from_list(map(make_integer, nums[:size // 10]) + [nil]))
+
+    def best(code):
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            result = run_code(code, env)
+            times.append(time.time() - start)
+        return min(times), result
+
+    run_code("(define vec (list->vector big))", env)
+    fold, result = best("(foldl + 0 small)")
+    fold = fold / (size // 10)
+    for name, code in [("foldl"        , None),
+                       ("apply"        , "(apply + big)"),
+                       ("vector-sum"   , "(vector-sum vec)"),
+                       ("list->vector" , "(list->vector big)"),
+                       ("vector->list" , "(vector->list vec)")]:
+        if code is None:
+            taken = fold
+        else:
+            taken, result = best(code)
+            taken = taken / size
+        print "%-12s %-13s %10.4fus per element %8.0fx" % (
+            "vector", name, 1e6 * taken, fold / taken)
+
+# -----------------------------------------------------------------------------
+# Hash tables
+#
+# Looking up keys spread through 10k symbols, in an association list with 
+# `assoc` (written in lisp, as it would be) and in a hash table.
+# -----------------------------------------------------------------------------
+
+assoc = """
+(define (assoc key alist)
+  (if (null? alist)
+    false
+    (if (equal? key (car (car alist)))
+      (car alist)
+      (assoc key (cdr alist)))))
+"""
+
+def hash_lookup(size=10000, lookups=10):
+    env = Environment([], [], basic_environment)
+    keys = [mksym("key-%d" % n) for n in range(size)]
+    env.define("alist", None, from_list([LispPair(key, make_integer(n)) 
+                                         for n, key in enumerate(keys)] + [nil]))
+    run_code(assoc, env)
+    run_code("(define table (make-hash-table))", env)
+    run_code("(define (fill alist) (if (null? alist) nil"
+             " (begin (hash-set! table (car (car alist)) (cdr (car alist))) (fill (cdr alist)))))", env)
+    run_code("(fill alist)", env)
+
+    wanted = keys[size // lookups // 2::size // lookups]
+    times = []
+    for name, code in [("assoc", "(cdr (assoc '%s alist))"), 
+                       ("hash-ref", "(hash-ref table '%s)")]:
+        start = time.time()
+        for key in wanted:
+            run_code(code % key, env)
+        taken = (time.time() - start) / len(wanted)
+        times.append(taken)
+        print "%-12s %-8s %6d keys %10.2fus per lookup %8.0fx" % (
+            "hash", name, size, 1e6 * taken, times[0] / taken)
+
+# -----------------------------------------------------------------------------
+# Classes
+#
+# Instances of a class with `members` variables, three classes down from
+# BaseClass: the time to make one and set one variable in it, the memory 
+# each uses (in a new process, as for lists) and the time to read a 
+# variable that is inherited.
+# -----------------------------------------------------------------------------
+
+def make_classes(members):
+    from datatypes import LispClass, class_base
+    top = LispClass([class_base])
+    for n in range(members):
+        top.define("m%d" % n, None, make_integer(n))
+    return LispClass([LispClass([top])])
+
+def build_instances(count, members):
+    # the part that runs in the new process
+    from datatypes import LispClass
+    cls = make_classes(members)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    instances = [LispClass([cls]) for n in xrange(count)]
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "memory: %d" % ((after - before) * 1024)
+
+def class_instances(members=50, count=10000, lookups=100000):
+    from datatypes import LispClass
+    cls = make_classes(members)
+
+    start = time.time()
+    for n in xrange(count):
+        instance = LispClass([cls])
+        instance.set("m0", make_integer(n))
+    taken = time.time() - start
+    print "%-12s %-8s %3d members %8.2fus per instance" % (
+        "class", "make", members, 1e6 * taken / count)
+
+    output = subprocess.check_output(
+        [sys.executable, __file__, "--instances", str(count), str(members)])
+    used = int(output.splitlines()[-1].split()[1])
+    print "%-12s %-8s %3d members %8.0f bytes per instance" % (
+        "class", "memory", members, float(used) / count)
+
+    start = time.time()
+    for n in xrange(lookups):
+        instance.get("m1")
+    taken = time.time() - start
+    print "%-12s %-8s %3d members %8.2fus per lookup" % (
+        "class", "get", members, 1e6 * taken / lookups)
+
+# -----------------------------------------------------------------------------
+# Bindings
+#
+# The memory used by each variable of a class with `count` of them (in a 
+# new process), and the time to get, set and chmod one.
+# -----------------------------------------------------------------------------
+
+def build_bindings(count):
+    # the part that runs in the new process
+    from datatypes import LispClass, class_base
+    cls = LispClass([class_base])
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for n in xrange(count):
+        cls.define("v%d" % n, None, nil)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "memory: %d" % ((after - before) * 1024)
+
+def class_bindings(count=100000, repeat=100000):
+    from datatypes import LispClass, class_base
+
+    output = subprocess.check_output(
+        [sys.executable, __file__, "--bindings", str(count)])
+    used = int(output.splitlines()[-1].split()[1])
+    print "%-12s %-8s %8.0f bytes per variable" % (
+        "binding", "memory", float(used) / count)
+
+    cls = LispClass([class_base])
+    cls.define("v", None, nil)
+    cls.define("w", None, nil)
+    cls.chmod("w", ["read-only"])
+    for name, action in [("get", lambda: cls.get("v")),
+                         ("set", lambda: cls.set("v", nil)),
+                         ("get r/o", lambda: cls.get("w")),
+                         ("chmod", lambda: cls.chmod("v", ["any-read", "no-virtual"]))]:
+        start = time.time()
+        for n in xrange(repeat):
+            action()
+        taken = time.time() - start
+        print "%-12s %-8s %8.2fus" % ("binding", name, 1e6 * taken / repeat)
+
+# -----------------------------------------------------------------------------
+# Method calls
+#
+# A loop calling a method of an instance (which calls two more on self),
+# and the same loop reading a variable of it.
+# -----------------------------------------------------------------------------
+
+methods = """
+(define Point (class BaseClass))
+(class-define! Point '_x)
+(class-define! Point '_y)
+(class-define! Point 'total)
+(class-set! Point 'total (lambda () (+ (self _x) (self _y))))
+(define p1 (class Point))
+(class-set! p1 '_x 4)
+(class-set! p1 '_y 6)
+
+(define (call-total i n) (if (= i n) i (begin (p1 total) (call-total (+ i 1) n))))
+(define (read-x i n) (if (= i n) i (begin (p1 _x) (read-x (+ i 1) n))))
+"""
+
+def method_calls(evaluators=("tree", "compile", "machine"), iterations=20000):
+    for evaluator in evaluators:
+        for name in ["call-total", "read-x"]:
+            code = "(%s 0 %d)" % (name, iterations)
+            taken, result = time_code(methods, code, evaluator, 3)
+            print "%-12s %-8s %-10s %8.2fus per loop" % (
+                "method", evaluator, name, 1e6 * taken / iterations)
+
+# -----------------------------------------------------------------------------
+# Profiling
+#
+# The fibonacci benchmark with the profiler running, and with the sampler
+# running, against without either (when they cost nothing, no hook or
+# thread is running).
+# -----------------------------------------------------------------------------
+
+def profile_overhead(evaluators=("tree", "compile", "machine")):
+    for evaluator in evaluators:
+        plain, result = time_code(fibonacci, "(fib 12)", evaluator, 3)
+
+        for name, profiler in [("profile", Profiler()), ("sample", Sampler(1000))]:
+            profiler.start()
+            try:
+                profiled, result = time_code(fibonacci, "(fib 12)", evaluator, 3)
+            finally:
+                profiler.stop()
+            print "%-12s %-8s %8.4fs %8.4fs %6.2fx" % (
+                name, evaluator, plain, profiled, profiled / plain)
+
+def counter_overhead(evaluators=("tree", "compile", "machine")):
+    # the same with the counters (see counters.py) enabled
+    for evaluator in evaluators:
+        plain, result = time_code(fibonacci, "(fib 12)", evaluator, 3)
+        counters.enable()
+        try:
+            counted, result = time_code(fibonacci, "(fib 12)", evaluator, 3)
+        finally:
+            counters.disable()
+            counters.reset()
+        print "%-12s %-8s %8.4fs %8.4fs %6.2fx" % (
+            "counters", evaluator, plain, counted, counted / plain)
+
+# -----------------------------------------------------------------------------
+# Startup with the autoloaded library
+#
+# Each script is run in a new process (so nothing is loaded already), timed
+# from starting it until it exits, python and the imports included. It
+# reports how many library modules it loaded. The first uses nothing in 
+# lib/, the others are compared with it: only the modules a script uses 
+# should add to its time.
+# -----------------------------------------------------------------------------
+
+scripts = [
+    ("none"     , "nil"),
+    ("car/cdr"  , "(car (cdr '(1 2 3)))"),
+    ("not"      , "(not (null? nil))"),
+    ("length"   , "(length '(1 2 3))"),
+    ("let"      , "(let ((a 1) (b 2)) (+ a b))"),
+    ("all"      , "(begin (let ((a 1)) a) (unfold cdr '(1 2) null?) new)")]
+
+def run_script(code):
+    # the part that runs in the new process
+    run_code(code, Environment([], [], basic_environment))
+    print "loads: %d" % module_cache.loads
+
+def autoload_startup(repeat=5):
+    baseline = None
+    for name, code in scripts:
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            output = subprocess.check_output(
+                [sys.executable, __file__, "--script", code])
+            taken = time.time() - start
+            loads = int(output.splitlines()[-1].split()[1])
+            if best is None or taken < best:
+                best = taken
+        if baseline is None:
+            baseline = best
+        print "%-12s %-8s %8.2fms %+8.2fms %d modules" % (
+            "startup", name, 1000 * best, 1000 * (best - baseline), loads)
+
+# -----------------------------------------------------------------------------
+# Memory used by a list
+#
+# A list of a million integers, either small ones (which are shared) or big
+# ones (a LispInteger each). Each is built in a new process which reports 
+# how much its peak memory grew.
+# -----------------------------------------------------------------------------
+
+def build_list(size, start):
+    # the part that runs in the new process
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = nil
+    for n in xrange(size):
+        result = LispPair(make_integer(start + n % 1000), result)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB
+    print "memory: %d" % ((after - before) * 1024)
+
+def memory_list(size=1000000):
+    for name, start in [("small", 0), ("big", 100000)]:
+        output = subprocess.check_output(
+            [sys.executable, __file__, "--list", str(size), str(start)])
+        used = int(output.splitlines()[-1].split()[1])
+        print "%-12s %-8s %8d elements %8.1fMB %6.1f bytes per element" % (
+            "memory", name, size, used / 2.0**20, float(used) / size)
+
+# -----------------------------------------------------------------------------
+# Suite
+#
+#   python bench.py --suite <results.json> [<baseline.json> [<threshold>]]
+#
+# Runs each workload under each evaluator, in a new process of its own so
+# its peak memory is its own, and saves the results as json:
+#
+#   {"python": "2.7.18",
+#    "results": {"fibonacci/tree": {"seconds": 0.046, "calls": 6904,
+#                                   "calls_per_second": 149843.1,
+#                                   "allocations": 1975, "peak_kb": 36},
+#                ...}}
+#
+# `seconds` is the best of a few runs, `calls` how many calls one run makes
+# to LispLambdas (methods too) and builtins, the same for every evaluator
+# (counted by the profiler, in a run of its own). `calls_per_second` is null
+# for a workload that makes none (import only evaluates defines).
+# `allocations` is the pairs, environments and call frames one run makes
+# (counted by counters.py, in another run) and `peak_kb` how far the peak 
+# memory of the timed runs is above what was used once the setup was done 
+# (see `reset_peak`).
+#
+# Given the results of an earlier run as a baseline, anything that takes
+# more time, allocations or memory than it did by more than `threshold` 
+# (0.25 is 25%) is reported and the exit status is 1. Memory is only 
+# compared above `memory_floor_kb` (one of python's memory arenas), growth 
+# much smaller than that is in the noise.
+# -----------------------------------------------------------------------------
+
+suite_setup = factorial + fibonacci + """
+(define (repeat n thunk) (if (= n 0) nil (begin (thunk) (repeat (- n 1) thunk))))
+(define (upto n acc) (if (= n 0) acc (upto (- n 1) (cons n acc))))
+(define numbers (upto 500 nil))
+
+(define swap (mac (f a b) `(,f ,b ,a)))
+
+(define Point (class BaseClass))
+(class-define! Point '_x)
+(class-define! Point '_y)
+(class-define! Point 'total)
+(class-set! Point 'total (lambda () (+ (self _x) (self _y))))
+(define (make-point x y)
+  (define p (class Point))
+  (class-set! p '_x x)
+  (class-set! p '_y y)
+  p)
+"""
+
+workloads = [
+    ("factorial", "(repeat 200 (lambda () (factorial 20)))"),
+    ("fibonacci", "(fib 15)"),
+    ("foldl"    , "(repeat 20 (lambda () (foldl + 0 numbers)))"),
+    ("foldr"    , "(repeat 20 (lambda () (foldr + 0 numbers)))"),
+    ("macros"   , "(repeat 1000 (lambda () (when true (let ((a 1) (b 2)) (swap - a b)))))"),
+    ("classes"  , "(repeat 1000 (lambda () ((make-point 1 2) total)))"),
+    ("import"   , '(reload "%(module)s")')]
+
+# the module the import workload reloads
+module_source = "".join(
+    "(define (f%d x) (if (< x %d) (cons x nil) (list x %d)))\n" % (n, n, n)
+    for n in range(1000))
+
+def run_workload(name, evaluator, repeat=5):
+    # the part that runs in the new process
+    code = dict(workloads)[name]
+    directory = tempfile.mkdtemp()
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        module = os.path.join(directory, "module.scm")
+        with open(module, "w") as stream:
+            stream.write(module_source)
+        code = code % {"module": module}
+
+        # before anything else so the counted runs don't add to it
+        set_evaluator(evaluator)
+        try:
+            env = Environment([], [], basic_environment)
+            run_code(suite_setup, env)
+            gc.collect()
+            before = reset_peak()
+            seconds, result = time_runs(code, env, repeat)
+            after = peak_memory()
+        finally:
+            set_evaluator("tree")
+
+        # the setup's calls and allocations are not part of the workload
+        calls = (count_calls(suite_setup, code, evaluator) - 
+                 count_calls(suite_setup, "nil", evaluator))
+        allocations = (count_allocations(suite_setup, code, evaluator) -
+                       count_allocations(suite_setup, "nil", evaluator))
+    finally:
+        sys.setrecursionlimit(limit)
+        shutil.rmtree(directory)
+
+    print json.dumps({
+        "seconds": seconds,
+        "calls": calls,
+        "calls_per_second": calls / seconds if calls else None,
+        "allocations": allocations,
+        "peak_kb": after - before})
+
+def memory_status():
+    # memory_status :: None -> {Str: Int}
+    # the memory lines (VmRSS, VmHWM...) of /proc/self/status in KB, none
+    # if it is not there
+    status = {}
+    try:
+        with open("/proc/self/status") as stream:
+            for line in stream:
+                if line.startswith("Vm"):
+                    name, value = line.split(":")
+                    status[name] = int(value.split()[0])
+    except EnvironmentError:
+        pass
+    return status
+
+def reset_peak():
+    # reset_peak :: None -> Int
+    # make the peak memory (KB) what is used now and return it. Only linux 
+    # can do that (/proc/self/clear_refs), elsewhere the peak is ru_maxrss
+    # which never goes down, so a workload that uses no more than the 
+    # imports and setup did grows it by 0
+    try:
+        with open("/proc/self/clear_refs", "w") as stream:
+            stream.write("5")
+    except EnvironmentError:
+        pass
+    return peak_memory()
+
+def peak_memory():
+    # peak_memory :: None -> Int
+    # see reset_peak, ru_maxrss is in KB on linux too
+    status = memory_status()
+    if "VmHWM" in status:
+        return status["VmHWM"]
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def count_calls(setup, code, evaluator):
+    # count_calls :: Str -> Str -> Str -> Int
+    # the procedure calls made by one run, but not special forms (only the
+    # tree walker pushes those on the stack) or macros (which are expanded
+    # once for each call site, however many times it is run)
+    profiler = Profiler()
+    profiler.start()
+    try:
+        time_code(setup, code, evaluator, 1)
+    finally:
+        profiler.stop()
+    return sum(stats.calls for func, stats in profiler.stats.items()
+               if (isinstance(func, LispLambda) and not func.macro) or
+                  getattr(func, "primitive", None) is not None)
+
+def count_allocations(setup, code, evaluator):
+    # count_allocations :: Str -> Str -> Str -> Int
+    # the pairs, environments and call frames made by one run
+    counters.reset()
+    counters.enable()
+    try:
+        time_code(setup, code, evaluator, 1)
+    finally:
+        counters.disable()
+    counts = counters.snapshot()
+    counters.reset()
+    return counts.get("pairs", 0) + counts.get("environments", 0)
+
+def run_suite(evaluators=("tree", "compile", "machine")):
+    # run_suite :: [Str] -> {Str: {Str: Float}}
+    results = {}
+    for name, code in workloads:
+        for evaluator in evaluators:
+            output = subprocess.check_output(
+                [sys.executable, __file__, "--workload", name, evaluator])
+            result = json.loads(output.splitlines()[-1])
+            results["%s/%s" % (name, evaluator)] = result
+            calls_per_second = result["calls_per_second"]
+            print "%-12s %-8s %8.4fs %10d calls %12s calls/s %10d allocations %8dKB" % (
+                name, evaluator, result["seconds"], result["calls"],
+                "-" if calls_per_second is None else "%.0f" % calls_per_second,
+                result["allocations"], result["peak_kb"])
+    return results
+
+memory_floor_kb = 256
+
+def regressions(results, baseline, threshold):
+    # regressions :: {Str: {Str: Float}} -> {Str: {Str: Float}} -> Float -> [Str]
+    # the workloads that take more time or memory than they did
+    found = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        for measure, floor in [("seconds", 0), ("allocations", 1),
+                               ("peak_kb", memory_floor_kb)]:
+            if measure not in baseline[key]:
+                # from before it was measured
+                continue
+            ratio = (float(max(results[key][measure], floor)) / 
+                     max(baseline[key][measure], floor))
+            worse = ratio > 1 + threshold
+            print "%-20s %-8s %12.4f %12.4f %6.2fx %s" % (
+                key, measure, baseline[key][measure], results[key][measure],
+                ratio, "REGRESSION" if worse else "")
+            if worse:
+                found.append("%s %s" % (key, measure))
+    return found
+
+def suite(output, baseline=None, threshold=0.25):
+    # suite :: Str -> Optional Str -> Float -> Int
+    # the exit status, 1 when something has regressed
+    results = run_suite()
+    with open(output, "w") as stream:
+        json.dump({"python": sys.version.split()[0], "results": results},
+                  stream, indent=2, sort_keys=True)
+
+    if baseline is None:
+        return 0
+    with open(baseline) as stream:
+        found = regressions(results, json.load(stream)["results"], threshold)
+    if found:
+        print "%d regressions: %s" % (len(found), ", ".join(found))
+        return 1
+    return 0
+
+if __name__ == "__main__" and sys.argv[1:2] == ["--script"]:
+    run_script(sys.argv[2])
+
+elif __name__ == "__main__" and sys.argv[1:2] == ["--list"]:
+    build_list(int(sys.argv[2]), int(sys.argv[3]))
+
+elif __name__ == "__main__" and sys.argv[1:2] == ["--instances"]:
+    build_instances(int(sys.argv[2]), int(sys.argv[3]))
+
+elif __name__ == "__main__" and sys.argv[1:2] == ["--bindings"]:
+    build_bindings(int(sys.argv[2]))
+
+elif __name__ == "__main__" and sys.argv[1:2] == ["--workload"]:
+    run_workload(sys.argv[2], sys.argv[3])
+
+elif __name__ == "__main__" and sys.argv[1:2] == ["--suite"]:
+    args = sys.argv[2:]
+    sys.exit(suite(args[0], args[1] if args[1:] else None,
+                   float(args[2]) if args[2:] else 0.25))
+
+elif __name__ == "__main__":
+    compare_evaluators()
+    lookup_depth()
+    scope_depth()
+    tokenize_size()
+    parse_length()
+    form_cache()
+    image_startup()
+    macro_loop()
+    variadic_sum()
+    vector_sum()
+    hash_lookup()
+    class_instances()
+    class_bindings()
+    method_calls()
+    profile_overhead()
+    counter_overhead()
+    autoload_startup()
+    memory_list()
@@ -0,0 +1,287 @@
+from datatypes import nil, true, mksym, from_list, to_list, first, rest, LispSymbol, LispPair, LispLambda, LispNil, LispBool, LispInteger, LispString, TailCall, LookupSite, trampoline, call_stack
+
+import function
+
+# -----------------------------------------------------------------------------
+# COMPILER
+#
+# An alternative to the tree walker. Rather than re-examining each sexp every
+# time it is evaluated a top level form is analysed once into a tree of python
+# closures. Each closure has the type:
+#
+#   code :: Environment 'env' -> LispBase
+#
+# The special forms are resolved, their syntax checked and their bodies split
+# while analysing so running a compiled LispLambda is just a call to the
+# closure stored in `LispLambda.code`.
+#
+# Code compiled in tail position (`tail=True`) may return a TailCall rather
+# than making the call itself, whoever called it must `trampoline` the result.
+# The body of a LispLambda is always compiled in tail position.
+#
+# Note: the core special forms (see `special_forms` below) are treated as
+# syntax. Rebinding `if` changes the tree walker but not compiled code.
+#
+# example:
+#   code = compile_sexp(sexp)
+#   result = code(env)
+# -----------------------------------------------------------------------------
+
+def compile_sexp(sexp, tail=False):
+    # compile_sexp :: LispBase -> Bool -> Code
+
+    if isinstance(sexp, LispSymbol):
+        return compile_symbol(sexp)
+
+    elif isinstance(sexp, LispPair):
+        operator = sexp.first
+        if isinstance(operator, LispSymbol) and operator.name in special_forms:
+            return special_forms[operator.name](sexp.rest, tail)
+        return compile_application(sexp, tail)
+
+    elif isinstance(sexp, (LispNil, LispBool, LispInteger, LispString)):
+        return compile_constant(sexp)
+
+    else:
+        # anything else (i.e. a procedure put in the code by a macro)
+        # does whatever its scm_eval does.
+        return lambda env: sexp.scm_eval(env)
+
+def compile_constant(value):
+    return lambda env: value
+
+def compile_symbol(sym):
+    # each reference gets its own inline cache
+    return LookupSite(sym.name).lookup
+
+def compile_sequence(sexps, tail):
+    # compile_sequence :: [LispBase] -> Bool -> Code
+
+    assert len(sexps) >= 1, "empty sequence"
+    codes = [compile_sexp(sexp) for sexp in sexps[:-1]]
+    codes.append(compile_sexp(sexps[-1], tail))
+
+    if len(codes) == 1:
+        return codes[0]
+
+    init = codes[:-1]
+    last = codes[-1]
+    def sequence(env):
+        for code in init:
+            code(env)
+        return last(env)
+    return sequence
+
+def compile_body(body, tail):
+    # compile_body :: LispPair -> Bool -> Code
+    body = to_list(body)
+    assert body[-1] is nil, "invalid body: %s" % body
+    return compile_sequence(body[:-1], tail)
+
+# -----------------------------------------------------------------------------
+# Application
+#
+# The operator is only known when the code runs so the application has to
+# handle every kind of callable:
+#
+#   LispLambda - eval the arguments and run the compiled body
+#   macro      - expand, compile the expansion and run it (both only the
+#                first time, see LispLambda.expand)
+#   primitive  - eval the arguments and call the python function directly
+#   otherwise  - call it with the raw arguments (special form / LispClass)
+#
+# The arguments are compiled the first time they are needed, that way the
+# arguments to a macro or special form never need to be valid code.
+#
+# In tail position the call to a LispLambda is returned as a TailCall,
+# otherwise it is trampolined here.
+# -----------------------------------------------------------------------------
+
+def compile_application(sexp, tail):
+
+    operator = compile_sexp(sexp.first)
+    args = sexp.rest
+    arg_codes = []
+    # the last expansion and its code
+    expanded = [None, None]
+
+    def compile_args():
+        list_args = to_list(args)
+        assert list_args[-1] is nil, "invalid application: %s" % sexp
+        arg_codes.extend(compile_sexp(arg) for arg in list_args[:-1])
+        arg_codes.append(None)
+
+    def application(env):
+        func = operator(env)
+        call_stack.append(func)
+
+        if isinstance(func, LispLambda):
+            if func.macro:
+                expansion = func.expand(args, env)
+                if expansion is not expanded[0]:
+                    expanded[:] = [expansion, compile_sexp(expansion, tail)]
+                result = expanded[1](env)
+            else:
+                if not arg_codes: compile_args()
+                evaled_args = [code(env) for code in arg_codes[:-1]]
+                result = func.apply(evaled_args, env)
+        else:
+            primitive = getattr(func, "primitive", None)
+            if primitive is not None:
+                if not arg_codes: compile_args()
+                result = primitive(*[code(env) for code in arg_codes[:-1]])
+            else:
+                assert callable(func), "cannot call '%s' in %s" % (func, sexp)
+                result = func(args, env)
+
+        if not tail:
+            while isinstance(result, TailCall):
+                # the tail called procedure takes over our place on the stack
+                call_stack[-1] = result.proc
+                result = result.proc.run(result.env)
+
+        call_stack.pop()
+        return result
+
+    return application
+
+# -----------------------------------------------------------------------------
+# Special Forms
+#
+# Each takes the arguments of the form (the cdr of the sexp) and returns code
+# doing the same as the function of the same name in function.py.
+# -----------------------------------------------------------------------------
+
+def compile_quote(args, tail):
+    args = to_list(args)
+    assert args[-1] is nil
+    assert len(args) == 2
+    return compile_constant(args[0])
+
+def compile_set(args, tail):
+    args = to_list(args)
+    assert args[-1] is nil
+    assert len(args) == 3
+    assert isinstance(args[0], LispSymbol)
+
+    name = args[0].name
+    value = compile_sexp(args[1])
+    def assignment(env):
+        env.set(name, value(env))
+        return nil
+    return assignment
+
+def compile_define(args, tail):
+
+    if isinstance(first(args), LispSymbol):
+        # (define <var> <value>)
+        list_args = to_list(args)
+        assert list_args[-1] is nil
+        assert len(list_args) == 3
+
+        var = list_args[0]
+        value = compile_sexp(list_args[1])
+
+    elif isinstance(first(args), LispPair):
+        # (define (<var> . <params>) <body1> ... )
+        var = first(first(args))
+        value = compile_procedure(rest(first(args)), rest(args), False)
+    else:
+        raise Exception("invalid form")
+
+    assert isinstance(var, LispSymbol)
+    name = var.name
+    def definition(env):
+        # todo set the datatype
+        env.define(name, None, value(env))
+        return nil
+    return definition
+
+def compile_if(args, tail):
+    args = to_list(args)
+    assert args[-1] is nil
+    assert 3 <= len(args) <= 4
+
+    predicate   = compile_sexp(args[0])
+    consequence = compile_sexp(args[1], tail)
+    alternative = compile_sexp(args[2], tail)
+
+    def conditional(env):
+        if predicate(env) is true:
+            return consequence(env)
+        else:
+            return alternative(env)
+    return conditional
+
+def compile_procedure(param, body, macro):
+    code = compile_body(body, True)
+    def procedure(env):
+        proc = LispLambda(param, body, macro, env)
+        proc.code = code
+        return proc
+    return procedure
+
+def compile_lambda(args, tail):
+    return compile_procedure(first(args), rest(args), False)
+
+def compile_macro(args, tail):
+    return compile_procedure(first(args), rest(args), True)
+
+def compile_begin(args, tail):
+    return compile_body(args, tail)
+
+def compile_quasiquote(args, tail):
+    assert rest(args) is nil, "ERROR (too many args in quasiquote)"
+    arg = first(args)
+
+    if not isinstance(arg, LispPair):
+        return compile_constant(arg)
+    return compile_template(arg)
+
+def compile_template(template):
+    # compile_template :: LispPair -> Code
+    # the same walk as `inner_qq` in function.quasiquote_func
+
+    if first(template) is mksym("unquote"):
+        # (unquote x) -> (eval x)
+        assert rest(rest(template)) is nil
+        return compile_sexp(first(rest(template)))
+
+    elif first(template) is mksym("quasiquote"):
+        # (quasiquote x) -> (quasiquote x)
+        assert rest(rest(template)) is nil
+        return compile_constant(template)
+
+    elif first(template) is mksym("unquote-splicing"):
+        raise Exception("Not implemented")
+
+    # each element is either constant or a template of its own
+    parts = []
+    while isinstance(template, LispPair):
+        if isinstance(first(template), LispPair):
+            parts.append(compile_template(first(template)))
+        else:
+            parts.append(compile_constant(first(template)))
+        template = rest(template)
+    parts.append(compile_constant(template))
+
+    def build(env):
+        return from_list([part(env) for part in parts])
+    return build
+
+special_forms = {
+    "quote"      : compile_quote,
+    "set!"       : compile_set,
+    "define"     : compile_define,
+    "if"         : compile_if,
+    "lambda"     : compile_lambda,
+    "begin"      : compile_begin,
+    "mac"        : compile_macro,
+    "quasiquote" : compile_quasiquote}
+
+# -----------------------------------------------------------------------------
+
+def compile_eval(sexp, env):
+    return trampoline(compile_sexp(sexp, True)(env))
+
+function.evaluators["compile"] = compile_eval
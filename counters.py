@@ -0,0 +1,258 @@
+from datatypes import nil, cons, mksym, from_list, make_integer, LispPair, LispLambda, Environment, Frame
+import datatypes
+
+# -----------------------------------------------------------------------------
+# Counters
+#
+# (stats)           - an association list of what has been counted
+# (stats-reset!)    - start counting from zero again
+# (stats-enable!)   - start counting
+# (stats-disable!)  - stop counting
+#
+# Counts the work the interpreter does while enabled:
+#
+#   eval-<type>      - scm_eval of each datatype, by its class name (a pair
+#                      evaluated in tail position with tail_eval too). The
+#                      tree walker evaluates everything with it. The compiler
+#                      only for what its code can't do itself and the machine
+#                      for atoms other than symbols (its own pairs and symbols
+#                      are not counted), both also for the arguments of the
+#                      special forms that evaluate their own, i.e. class-set!
+#   lookups          - each lookup of a name, in a call Frame or an
+#                      Environment, or cached by a LookupSite
+#   lookup-steps     - the frames and environments walked by them, one for a
+#                      name found in the first or in the cache (their average
+#                      is `lookup-average`, only in the python dict as lisp
+#                      has no floats)
+#   environments     - Environments and call Frames made
+#   pairs            - LispPairs made
+#   macro-expansions - macro calls expanded (not those found already
+#                      expanded, see LispLambda.expand)
+#   imports          - `import` and `reload` calls
+#   includes         - `include` calls
+#   file-reads       - source files read for them
+#
+# Counting is done by putting counting versions of those methods on their
+# classes when it is enabled and the originals back when it is disabled,
+# so when it is not enabled it costs nothing at all. The counts are kept
+# until reset.
+#
+# A LookupSite that finds what it cached calls nothing that can be replaced
+# (and the compiler keeps each one's bound `lookup`), all it does is compare
+# its epoch with `datatypes.epoch`. So while counting that is a CountingEpoch,
+# which is the same number but counts each time it is found equal.
+#
+# example:
+#   enable()
+#   ...
+#   counts = snapshot()
+#
+#   or in lisp
+#   (stats-enable!)
+#   (stats)
+# -----------------------------------------------------------------------------
+
+# {Str: Int}
+counts = {}
+enabled = False
+
+# [(class, Str, function)] each method replaced while counting, with the
+# original to put back
+replaced = []
+
+def count(name, n=1):
+    # count :: Str -> Int -> None
+    counts[name] = counts.get(name, 0) + n
+
+def counting_eval(original):
+    def scm_eval(self, env):
+        key = "eval-" + type(self).__name__
+        counts[key] = counts.get(key, 0) + 1
+        return original(self, env)
+    return scm_eval
+
+# the lookups that are not counted, made by counting_get
+environment_get = Environment.__dict__["get"]
+frame_get = Frame.__dict__["get"]
+
+def walk(env, var):
+    # walk :: Environment | Frame -> Str -> (Environment | Frame, Int)
+    # the frame or environment that has `var` (or the last one) and how many
+    # were looked in
+    steps = 1
+    while True:
+        if type(env) is Frame:
+            if var in env.slots or (env.extra is not None and var in env.extra):
+                break
+            parent = env.outer
+        else:
+            if var in env.variables:
+                break
+            parent = env.parent()
+        if parent is None:
+            break
+        env = parent
+        steps += 1
+    return env, steps
+
+def counting_get(original):
+    def get(self, var):
+        # walk to where `var` is here, then look it up there, so the walk 
+        # is counted once rather than once for each frame and environment
+        env, steps = walk(self, var)
+        count("lookups")
+        count("lookup-steps", steps)
+        if type(env) is Frame:
+            return frame_get(env, var)
+        return environment_get(env, var)
+    return get
+
+class CountingEpoch(int):
+    """datatypes.epoch while counting, see LookupSite.lookup"""
+
+    def __eq__(self, other):
+        # int == CountingEpoch uses this too, it is a subclass of int
+        equal = int(self) == int(other)
+        if equal:
+            count("lookups")
+            count("lookup-steps")
+        return equal
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __add__(self, other):
+        return CountingEpoch(int(self) + other)
+
+    __hash__ = int.__hash__
+
+def counting_call(name, original):
+    def call(*args):
+        count(name)
+        return original(*args)
+    return call
+
+def counting_forms(original):
+    def forms(self):
+        if self.sexps is None:
+            count("file-reads")
+        return original(self)
+    return forms
+
+def instrumented():
+    # instrumented :: None -> [(class, Str, function -> function)]
+    # each method to count and how to make the counting version of it
+    from function import Module, ModuleCache  # function imports this module
+    methods = [(cls, "scm_eval", counting_eval) for cls in vars(datatypes).values()
+               if isinstance(cls, type) and "scm_eval" in cls.__dict__]
+    methods.extend([
+        (LispPair, "tail_eval", counting_eval),
+        (Environment, "get", counting_get),
+        (Frame, "get", counting_get),
+        (Environment, "__init__", lambda original: counting_call("environments", original)),
+        (Frame, "__init__", lambda original: counting_call("environments", original)),
+        (LispPair, "__init__", lambda original: counting_call("pairs", original)),
+        (LispLambda, "cache_expansion", lambda original: counting_call("macro-expansions", original)),
+        (ModuleCache, "import_module", lambda original: counting_call("imports", original)),
+        (ModuleCache, "include", lambda original: counting_call("includes", original)),
+        (Module, "forms", counting_forms)])
+    return methods
+
+def enable():
+    # enable :: None -> None
+    global enabled
+    if enabled:
+        return
+    for cls, attr, wrap in instrumented():
+        original = cls.__dict__[attr]
+        replaced.append((cls, attr, original))
+        setattr(cls, attr, wrap(original))
+    # the same epoch, so no cached lookup is lost
+    datatypes.epoch = CountingEpoch(datatypes.epoch)
+    enabled = True
+
+def disable():
+    # disable :: None -> None
+    global enabled
+    while replaced:
+        cls, attr, original = replaced.pop()
+        setattr(cls, attr, original)
+    if type(datatypes.epoch) is CountingEpoch:
+        # a new one, every LookupSite holding a CountingEpoch looks again
+        # (uncounted) and keeps a plain int instead
+        datatypes.epoch = int(datatypes.epoch) + 1
+    enabled = False
+
+def reset():
+    # reset :: None -> None
+    counts.clear()
+
+def snapshot():
+    # snapshot :: None -> {Str: Int | Float}
+    result = dict(counts)
+    if result.get("lookups"):
+        result["lookup-average"] = float(result["lookup-steps"]) / result["lookups"]
+    return result
+
+def to_alist():
+    # to_alist :: None -> LispPair
+    return from_list([cons(mksym(name), make_integer(value))
+                      for name, value in sorted(counts.items())] + [nil])
+
+# -----------------------------------------------------------------------------
+
+def test():
+    print "testing: counters"
+    from lex import tokenize
+    from parse import parse
+    from function import evaluate, basic_environment
+
+    def run(text, env):
+        for sexp in parse(tokenize([text])):
+            evaluate(sexp, env)
+
+    env = Environment([], [], basic_environment)
+    run("(define (f x) (cons x nil))", env)
+    original = LispPair.__dict__["scm_eval"]
+
+    reset()
+    enable()
+    try:
+        assert LispPair.__dict__["scm_eval"] is not original
+        run("(f 1) (f 2)", env)
+    finally:
+        disable()
+    assert LispPair.__dict__["scm_eval"] is original
+
+    counts_then = snapshot()
+    assert counts_then["eval-LispPair"] >= 2, counts_then
+    assert counts_then["pairs"] >= 2, counts_then
+    assert counts_then["lookups"] >= 1, counts_then
+    assert counts_then["lookup-average"] >= 1, counts_then
+
+    # nothing is counted while disabled
+    run("(f 3)", env)
+    assert snapshot() == counts_then
+    reset()
+    assert snapshot() == {}
+
+# -----------------------------------------------------------------------------
+
+def stats_func(args, env):
+    assert args is nil
+    return to_alist()
+
+def stats_reset_func(args, env):
+    assert args is nil
+    reset()
+    return nil
+
+def stats_enable_func(args, env):
+    assert args is nil
+    enable()
+    return nil
+
+def stats_disable_func(args, env):
+    assert args is nil
+    disable()
+    return nil
@@ -1,13 +1,39 @@
+import sys
+import array
+import operator
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 debug = False
 
+# Procedures close over the environment they were made in. Setting this makes
+# them extend the environment they are called from instead, as they used to.
+dynamic_scope = False
+
 # ----------------------------------------------------------------------------
 
+# The values are made in great numbers (a list is a pair per element) so 
+# they have `__slots__` rather than a `__dict__` each. Anything else made
+# from LispBase (i.e. LispClass) still gets a `__dict__` unless it too has
+# `__slots__`.
+#
+# Values that are `equal?` (python's ==) hash the same, so any of them can 
+# be a key of a dict (see LispHashTable). nil, booleans, symbols and 
+# procedures are only equal to themselves and keep the default hash, 
+# integers, strings and pairs hash what is in them. Vectors can be changed
+# so they can't be hashed.
+
 class LispBase(object):
-    pass
+    __slots__ = ()
     
 # ----------------------------------------------------------------------------
 
 class LispNil(LispBase):
+    __slots__ = ()
     def __init__(self): pass
     def scm_eval(self, env): return self
     def __str__(self): return "nil"
@@ -18,6 +44,8 @@ nil = LispNil()
 # ----------------------------------------------------------------------------
 
 class LispSymbol(LispBase):
+    __slots__ = ("name",)
+
     def __init__(self, name):
         """__init__ :: Str 'name' -> None"""
         assert isinstance(name, str)
@@ -32,6 +60,10 @@ class LispSymbol(LispBase):
     def __eq__(self, other): 
         return self is other
 
+    def __reduce__(self):
+        # symbols are interned when they are unpickled too
+        return (mksym, (self.name,))
+
 obarray = {}
 
 def mksym(name):
@@ -47,12 +79,61 @@ def mksym(name):
 call_stack = []
 
 class LispPair(LispBase):
+
+    __slots__ = ("first", "rest", "site", "expansion")
+
     def __init__(self, first, rest):
         self.first = first
         self.rest = rest
+
+        # made the first time `first` is evaluated as a symbol, see 
+        # LookupSite
+        self.site = None
+
+        # (macro, expansion) when this is the arguments of a macro call, 
+        # see LispLambda.expand
+        self.expansion = None
+
+    def eval_first(self, env):
+        # eval_first :: Environment -> LispBase
+        # evaluate `first`, with the pair as its LookupSite
+        if type(self.first) is LispSymbol:
+            site = self.site
+            if site is None:
+                site = self.site = LookupSite(self.first.name)
+            return site.lookup(env)
+        return self.first.scm_eval(env)
     
     def scm_eval(self, env):
-        func = self.first.scm_eval(env)
+        func = self.eval_first(env)
+        assert callable(func), "cannot call '%s' in %s" % (func, self)
+        call_stack.append(func)
+        result = func(self.rest, env)
+        while isinstance(result, TailCall):
+            # the tail called procedure takes over our place on the stack
+            call_stack[-1] = result.proc
+            result = result.proc.run(result.env)
+        call_stack.pop()
+        return result
+
+    def __getstate__(self):
+        # the LookupSite and expansion are only caches, they can be made again.
+        # The pairs after this one are saved with it as a python list of
+        # their elements (and the tail), so pickle does not recurse down a
+        # long list. They are made again when it is loaded, so only this pair
+        # is still shared with anything else that refers to it.
+        return to_list(self)
+
+    def __setstate__(self, state):
+        # build the rest from the back, see from_list
+        self.first = state[0]
+        self.rest = from_list(state[1:])
+        self.site = None
+        self.expansion = None
+
+    def tail_eval(self, env):
+        # the same as scm_eval but any TailCall is left for the caller
+        func = self.eval_first(env)
         assert callable(func), "cannot call '%s' in %s" % (func, self)
         call_stack.append(func)
         result = func(self.rest, env)
@@ -60,22 +141,66 @@ class LispPair(LispBase):
         return result
 
     def __str__(self):
-        text = "( "
-        sexp = self
-        while (isinstance(sexp, LispPair)):
-            text += str(sexp.first) + " "
-            sexp = sexp.rest
-        
-        if sexp is not nil:
-            text += ". " + str(sexp) + " "
-        text += ")"
-        return text
+        # see printer.py, it does not recurse on nested lists
+        from printer import to_string
+        return to_string(self)
 
     def __eq__(self, other):
-        if not isinstance(other, LispPair):
-            return False
+        # the pairs still to compare are kept in a list rather than on the
+        # python stack, so any length or nesting is fine
+        todo = [(self, other)]
+        while todo:
+            a, b = todo.pop()
+            if isinstance(a, LispPair):
+                if not isinstance(b, LispPair):
+                    return False
+                if a is not b:
+                    todo.append((a.rest, b.rest))
+                    todo.append((a.first, b.first))
+            elif not a == b:
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        # combines the hash of each element, in the order __eq__ visits 
+        # them, with a marker for each pair so that i.e. ( a b ) and 
+        # ( ( a ) b ) differ. Pairs are never changed so this never does.
+        result = 0x345678
+        todo = [self]
+        while todo:
+            value = todo.pop()
+            if isinstance(value, LispPair):
+                todo.append(value.rest)
+                todo.append(value.first)
+                h = 0x5a17
+            else:
+                h = hash(value)
+            result = ((result * 1000003) ^ h) & sys.maxint
+        return result
+
+def tail_eval(sexp, env):
+    """tail_eval :: LispBase -> Environment -> LispBase | TailCall
+
+    Evaluate a sexp that is in tail position. Special forms call this for 
+    their last sexp so that the call can be made by the trampoline of the 
+    enclosing scm_eval instead of growing the python stack."""
+    if isinstance(sexp, LispPair):
+        return sexp.tail_eval(env)
+    return sexp.scm_eval(env)
 
-        return self.first == other.first and self.rest == other.rest
+def eval_list(args, env):
+    """eval_list :: LispPair -> Environment -> [LispBase]
+
+    Evaluate each element of a proper list (i.e. the arguments of a call)"""
+    result = []
+    while isinstance(args, LispPair):
+        result.append(args.eval_first(env))
+        args = args.rest
+    assert args is nil, "invalid arguments: %s" % args
+    return result
 
 def get_stack():
     return from_list(call_stack)
@@ -88,12 +213,12 @@ def from_list(args):
     # note that for a proper list a nil must be put at the end
     if len(args) == 0: 
         return nil
-    elif len(args) == 1: 
-        return args[0]
-    elif len(args) == 2: 
-        return cons(args[0], args[1])
-    else:
-        return cons(args[0], from_list(args[1:]))
+
+    # build it from the back, each pair only needs the one after it
+    result = args[-1]
+    for n in xrange(len(args) - 2, -1, -1):
+        result = LispPair(args[n], result)
+    return result
 
 def to_list(sexp):
     # from_list :: LispPair -> [LispBase]
@@ -115,34 +240,38 @@ def rest(args):
 
 # ----------------------------------------------------------------------------
 
-def extended_env(scm_vars, scm_args, env):
-    """extended_env :: [Str] -> [LispBase] -> Environment -> Environment"""
-    
-    if scm_vars[-1] is nil:
-        # we have a normal list (ending in nil)
-        # remove the ending nil
-        evaled_vars = scm_vars[:-1]
-        evaled_args = scm_args[:-1]
-    else:
-        # we have a dotted form
-        # create the combined 'rest'
-        evaled_vars = scm_vars
-        start_args = scm_args[:len(scm_vars)-1]
-        rest_args  = from_list(scm_args[len(scm_vars)-1:])
-        evaled_args = start_args + [rest_args]
-
-    # vars and args must match exactly
-    assert len(evaled_vars) == len(evaled_args)
-            
-    # extend the Environment with the new frame
-    return Environment(evaled_vars, evaled_args, env)
+class TailCall(object):
+    """A call to a LispLambda that has been left for the caller to make. 
+    Returning one of these rather than calling `proc.run` directly is what 
+    keeps tail calls from using any python stack."""
+
+    __slots__ = ("proc", "env")
+
+    def __init__(self, proc, env):
+        self.proc = proc
+        self.env = env
+
+def name_procedure(value, name):
+    """name_procedure :: LispBase -> Str -> None"""
+    # a procedure is known by the first name it is defined as
+    if type(value) is LispLambda and value.name is None:
+        value.name = name
+
+def trampoline(result):
+    """trampoline :: LispBase | TailCall -> LispBase"""
+    while isinstance(result, TailCall):
+        result = result.proc.run(result.env)
+    return result
 
 class LispLambda(object):
 
     lambda_id = 0
 
-    def __init__(self, scm_vars, body, macro=False):
-        """Procedure :: SchemeBase -> LispPair"""
+    # the name it was first defined under, to report it by (see profiler.py)
+    name = None
+
+    def __init__(self, scm_vars, body, macro=False, env=None):
+        """Procedure :: SchemeBase -> LispPair -> Bool -> Environment"""
 
         LispLambda.lambda_id += 1
         self.id = LispLambda.lambda_id
@@ -150,23 +279,40 @@ class LispLambda(object):
         self.body = cons(mksym("begin"), body)
         self.macro = macro
 
+        # where the procedure was made, the parent of each call frame
+        # (unless `dynamic_scope` is set)
+        self.env = env
+
+        # the compiler (see compiler.py) can give us a python closure 
+        # to run instead of walking `self.body`
+        self.code = None
+
+        # work out the layout of the call frame once, rather than on every 
+        # call. Each parameter gets a slot, a dotted (rest) parameter gets 
+        # the last one.
         if scm_vars is nil:
-            self.scm_vars = [nil]
+            params, rest_param = [], None
         elif isinstance(scm_vars, LispSymbol):
-            self.scm_vars = [str(scm_vars)]
+            params, rest_param = [], str(scm_vars)
         else:
             assert isinstance(scm_vars, LispPair)
             list_vars = to_list(scm_vars)
-            self.scm_vars = map(str, list_vars[:-1]) 
+            params = map(str, list_vars[:-1]) 
             if list_vars[-1] is nil:
-                self.scm_vars.append(nil)
+                rest_param = None
             else:
-                self.scm_vars.append(str(list_vars[-1]))
+                rest_param = str(list_vars[-1])
+
+        self.arity = len(params)
+        self.variadic = rest_param is not None
+        self.names = params + ([rest_param] if self.variadic else [])
+        self.slots = dict((name, n) for n, name in enumerate(self.names))
+        frame_names.update(self.names)
         
         if debug:
             print "lambda-init"
             print "\told vars\t", scm_vars
-            print "\tnew vars\t", self.scm_vars
+            print "\tnew vars\t", self.names
             print "\tbody\t", self.body
 
     def expand_macro(self, args, env):
@@ -175,36 +321,119 @@ class LispLambda(object):
         assert self.macro
 
         # extend the Environment with the new frame
-        new_env = extended_env(self.scm_vars, to_list(args), env)
+        list_args = to_list(args)
+        assert list_args[-1] is nil, "invalid macro call: %s" % args
+        new_env = self.bind(list_args[:-1], env)
 
         # eval in a the new environment to get the macro expansion
-        return self.body.scm_eval(new_env)
+        return trampoline(self.run(new_env))
+
+    # A macro call is only expanded the first time it is evaluated, after
+    # that the expansion kept on its arguments (the rest of the call's pair)
+    # is used, as long as the call is still to the same macro. Redefining
+    # the macro makes a new one so the call is expanded again. So an 
+    # expansion must only depend on the arguments, as is true of one made
+    # with quasiquote. With `dynamic_scope` it can depend on the caller's
+    # variables as well so nothing is kept.
+
+    def cached_expansion(self, args):
+        """cached_expansion :: LispBase -> Optional LispBase"""
+        if type(args) is LispPair and not dynamic_scope:
+            cached = args.expansion
+            if cached is not None and cached[0] is self:
+                return cached[1]
+        return None
+
+    def cache_expansion(self, args, expansion):
+        """cache_expansion :: LispBase -> LispBase -> None"""
+        # nil (no arguments) is shared by every call so is never used
+        if type(args) is LispPair and not dynamic_scope:
+            args.expansion = (self, expansion)
+
+    def expand(self, args, env):
+        """expand :: LispBase -> Environment -> LispBase"""
+        expansion = self.cached_expansion(args)
+        if expansion is None:
+            expansion = self.expand_macro(args, env)
+            self.cache_expansion(args, expansion)
+        return expansion
+
+    def run(self, env):
+        """run :: Environment -> LispBase | TailCall"""
+        if self.code is not None:
+            return self.code(env)
+        return self.body.tail_eval(env)
+
+    def bind(self, evaled_args, env):
+        """bind :: [LispBase] -> Environment -> Frame
+
+        Make the call frame for a call with `evaled_args`, a python list 
+        which the frame takes ownership of. `env` is where the call is 
+        made from, it is only used with `dynamic_scope`."""
+
+        if not dynamic_scope:
+            return self.frame(evaled_args, self.env)
+
+        # A call frame where every variable is shadowed by the new frame 
+        # can never be seen from it so skip over it. Without this a tail 
+        # recursive loop would build an ever growing chain of dead frames.
+        while (type(env) is Frame and env.extra is None and
+               (env.slots is self.slots or self.slots.viewkeys() >= env.slots.viewkeys())):
+            env = env.outer
+
+        return self.frame(evaled_args, env)
+
+    def frame(self, evaled_args, outer):
+        """frame :: [LispBase] -> Environment -> Frame"""
+
+        values = evaled_args
+        if self.variadic:
+            # create the combined 'rest'
+            assert len(values) >= self.arity, "%s needs at least %d args, got %d" % (self, self.arity, len(values))
+            rest_args = values[self.arity:]
+            del values[self.arity:]
+            rest_args.append(nil)
+            values.append(from_list(rest_args))
+        else:
+            # vars and args must match exactly
+            assert len(values) == self.arity, "%s needs %d args, got %d" % (self, self.arity, len(values))
+
+        return Frame(self.slots, values, outer)
+
+    def apply(self, evaled_args, env):
+        """apply :: [LispBase] -> Environment -> TailCall"""
+
+        # the body gets evaled in the new Environment by the trampoline
+        return TailCall(self, self.bind(evaled_args, env))
 
     def __call__(self, args, env):
         """__call__ :: SchemePair -> Environment"""
 
         if self.macro:
-            # expand in a new env
-            mac = self.expand_macro(args, env)
+            # expand in a new env (once)
+            mac = self.expand(args, env)
             if debug: print "\tmacro\t", mac
             # call in the *old* one.
-            return mac.scm_eval(env)
+            return tail_eval(mac, env)
        
         # eval everything and return as a list
-        evaled_args = [arg.scm_eval(env) for arg in to_list(args)]
+        evaled_args = eval_list(args, env)
         
         if debug:
             print "lambda-call"
-            print "\tpre vars\t", self.scm_vars
+            print "\tpre vars\t", self.names
             print "\tpre args\t", args
             print "\tevl args\t", [str(x) for x in evaled_args]
 
-        # extend the Environment with the new frame
-        new_env = extended_env(self.scm_vars, evaled_args, env)
-
-        # eval the body in the new Environment
-        return self.body.scm_eval(new_env)
+        return self.apply(evaled_args, env)
     
+    def __getstate__(self):
+        # python closures can't be pickled, without `code` the body is
+        # walked instead
+        state = self.__dict__.copy()
+        state["code"] = None
+        return state
+
     def scm_eval(self, env):
         return mksym(str(self))
 
@@ -218,7 +447,48 @@ class LispLambda(object):
 
 # ----------------------------------------------------------------------------
 
+class ContinuationInvoked(Exception):
+    """Unwinds the python stack back to whoever can resume `continuation`"""
+    def __init__(self, continuation, value):
+        Exception.__init__(self, str(continuation))
+        self.continuation = continuation
+        self.value = value
+
+class Continuation(object):
+    """The rest of a computation as made by `call/cc`. 
+    
+    The machine evaluator (see machine.py) captures its whole continuation 
+    stack in `stack` so it can resume it any number of times. The other 
+    evaluators leave `stack` as None and can only escape with it."""
+
+    continuation_id = 0
+
+    def __init__(self, stack=None, calls=None):
+        Continuation.continuation_id += 1
+        self.id = Continuation.continuation_id
+        self.stack = stack
+        self.calls = calls
+
+    def __call__(self, args, env):
+        """__call__ :: SchemePair -> Environment"""
+        args = to_list(args)
+        assert args[-1] is nil
+        assert len(args) == 2, "a continuation takes one value"
+        raise ContinuationInvoked(self, args[0].scm_eval(env))
+
+    def scm_eval(self, env):
+        return mksym(str(self))
+
+    def __str__(self):
+        return "<#continuation-%d#>" % self.id
+
+    def __eq__(self, other):
+        return self is other
+
+# ----------------------------------------------------------------------------
+
 class LispBool(LispBase):
+    __slots__ = ("val",)
     def __init__(self, val): 
         assert (val is True) or (val is False)
         self.val = val
@@ -234,6 +504,7 @@ false = LispBool(False)
 # ----------------------------------------------------------------------------
 
 class LispString(LispBase):
+    __slots__ = ("text",)
     def __init__(self, text):
         assert isinstance(text, str)
         self.text = text
@@ -243,10 +514,13 @@ class LispString(LispBase):
         if not isinstance(other, LispString):
             return False
         return self.text == other.text
+    def __ne__(self, other): return not self == other
+    def __hash__(self): return hash(self.text)
 
 # ----------------------------------------------------------------------------
 
 class LispInteger(LispBase):
+    __slots__ = ("num",)
     def __init__(self, num):
         assert isinstance(num, int)
         self.num = num
@@ -256,61 +530,244 @@ class LispInteger(LispBase):
         if not isinstance(other, LispInteger):
             return False
         return cmp(self.num,other.num)
+    def __eq__(self, other):
+        if not isinstance(other, LispInteger):
+            return False
+        return self.num == other.num
+    def __ne__(self, other): return not self == other
+    def __hash__(self): return hash(self.num)
+    def __reduce__(self):
+        # so small ones are shared when they are unpickled too
+        return (make_integer, (self.num,))
+
+# The integers from `small_min` to `small_max` are made once, here, and
+# shared. Anything making a LispInteger from a number that may well be
+# small (arithmetic, the parser) should use `make_integer`. They are only
+# values so sharing them makes no difference, except to `is?`.
+
+small_min = -256
+small_max = 65535
+small_integers = [LispInteger(n) for n in xrange(small_min, small_max + 1)]
+
+def make_integer(num):
+    """make_integer :: Int -> LispInteger"""
+    if small_min <= num <= small_max:
+        return small_integers[num - small_min]
+    return LispInteger(num)
+
+# ----------------------------------------------------------------------------
+# Vectors
+#
+# A fixed number of integers in one contiguous typed buffer, a numpy array
+# (of int64) when numpy can be imported and an array.array (of C longs) 
+# otherwise. Indexing is constant time, and summing, the dot product and
+# element-wise arithmetic run over the whole buffer at once rather than a
+# LispPair at a time. An integer that does not fit is an error with 
+# array.array, numpy wraps it around.
+#
+# example:
+#   vec = make_vector([1, 2, 3])
+#   vec.sum()            => 6
+#   vec.combine(operator.mul, 2)
+# ----------------------------------------------------------------------------
+
+def make_buffer(nums):
+    # make_buffer :: Iterable Int -> Buffer
+    if numpy is not None:
+        return numpy.fromiter(nums, numpy.int64)
+    return array.array("l", nums)
+
+class LispVector(LispBase):
+    __slots__ = ("items",)
+
+    def __init__(self, items):
+        """__init__ :: Buffer 'items' -> None"""
+        self.items = items
+
+    def scm_eval(self, env): return self
+
+    def __len__(self):
+        return len(self.items)
+
+    def ref(self, n):
+        """ref :: Int -> LispInteger"""
+        assert 0 <= n < len(self.items), "index %d out of range" % n
+        return make_integer(int(self.items[n]))
+
+    def set(self, n, num):
+        """set :: Int -> Int -> None"""
+        assert 0 <= n < len(self.items), "index %d out of range" % n
+        self.items[n] = num
+
+    def nums(self):
+        """nums :: None -> [Int]"""
+        return self.items.tolist()
+
+    def sum(self):
+        """sum :: None -> Int"""
+        if numpy is not None:
+            return int(self.items.sum())
+        return sum(self.items)
+
+    def dot(self, other):
+        """dot :: LispVector -> Int"""
+        assert len(self) == len(other), "vectors of length %d and %d" % (len(self), len(other))
+        if numpy is not None:
+            return int(numpy.dot(self.items, other.items))
+        return sum(itertools.imap(operator.mul, self.items, other.items))
+
+    def combine(self, op, other):
+        """combine :: (Int -> Int -> Int) -> LispVector | Int -> LispVector
+
+        `op` of each element and the same element of `other`, or `other` 
+        itself if it is a number"""
+        if isinstance(other, LispVector):
+            assert len(self) == len(other), "vectors of length %d and %d" % (len(self), len(other))
+            other = other.items
+            if numpy is None:
+                return LispVector(make_buffer(itertools.imap(op, self.items, other)))
+        elif numpy is None:
+            return LispVector(make_buffer(op(x, other) for x in self.items))
+        return LispVector(op(self.items, other))
+
+    def __str__(self):
+        return "#(%s )" % "".join(" %d" % n for n in self.nums())
+
+    def __eq__(self, other):
+        if not isinstance(other, LispVector):
+            return False
+        return self.nums() == other.nums()
+
+    # the elements can be changed, so it can't be a key
+    __hash__ = None
+
+def make_vector(nums):
+    """make_vector :: Iterable Int -> LispVector"""
+    return LispVector(make_buffer(nums))
+
+# ----------------------------------------------------------------------------
+# Hash tables
+#
+# A dict from keys to values, both any lisp value. Keys are found by 
+# `equal?` (see the hashing notes at LispBase) in constant time on average.
+# The table itself is only equal to itself.
+# ----------------------------------------------------------------------------
+
+class LispHashTable(LispBase):
+    __slots__ = ("table",)
+
+    def __init__(self):
+        self.table = {}
+
+    def scm_eval(self, env): return self
+
+    def ref(self, key, default=None):
+        """ref :: LispBase -> Optional LispBase -> LispBase"""
+        value = self.table.get(key, default)
+        assert value is not None, "key not found: %s" % key
+        return value
+
+    def set(self, key, value):
+        """set :: LispBase -> LispBase -> None"""
+        self.table[key] = value
+
+    def remove(self, key):
+        """remove :: LispBase -> None"""
+        self.table.pop(key, None)
+
+    def __len__(self):
+        return len(self.table)
+
+    def to_alist(self):
+        """to_alist :: None -> LispPair
+
+        each key and value as a list of pairs, in no particular order"""
+        return from_list([LispPair(key, value) for key, value in self.table.iteritems()] + [nil])
+
+    def __str__(self):
+        from printer import to_string
+        return "#hash" + to_string(self.to_alist())
 
 # -----------------------------------------------------------------------------
 
+# ----------------------------------------------------------------------------
+# Permissions
+#
+# Who can read and write a variable, as a mask of the bits below. There
+# are only 32 possible permissions so each is made once (see 
+# `make_permission`) and shared by every variable that has it, they are 
+# never changed. chmod gives the variable a different one.
+#
+#   CLASS_READ / CLASS_WRITE - from inside the class (its procedures)
+#   ANY_READ / ANY_WRITE     - from anywhere
+#   VIRTUAL                  - not in this class, only in what is made from it
+#
+# A variable can be read from anywhere, without any other checks, when its
+# mask has ANY_READ but not VIRTUAL: `mask & READ_CHECK == ANY_READ`.
+# ----------------------------------------------------------------------------
+
+CLASS_READ, CLASS_WRITE, ANY_READ, ANY_WRITE, VIRTUAL = 1, 2, 4, 8, 16
+READ_CHECK = ANY_READ | VIRTUAL
+WRITE_CHECK = ANY_WRITE | VIRTUAL
+
+# flag: (bits to set, bits to clear), all of the bits are set before any are
+# cleared
+permission_flags = {
+    "class-read"     : (CLASS_READ, 0),
+    "class-write"    : (CLASS_WRITE, 0),
+    "any-read"       : (ANY_READ, 0),
+    "any-write"      : (ANY_WRITE, 0),
+    "virtual"        : (VIRTUAL, 0),
+    "no-class-read"  : (0, CLASS_READ),
+    "no-class-write" : (0, CLASS_WRITE),
+    "no-any-read"    : (0, ANY_READ),
+    "no-any-write"   : (0, ANY_WRITE),
+    "no-virtual"     : (0, VIRTUAL),
+    "read-only"      : (0, ANY_WRITE | CLASS_WRITE),
+    "private"        : (0, ANY_READ | ANY_WRITE)}
+
 class Permission(object):
-    def __init__(self, flags=None):
-        self.set_default()
-        if flags:
-            self.set_flags(flags)
-
-    def set_default(self):
-        self.class_read  = True
-        self.class_write = True
-        self.any_read    = True
-        self.any_write   = True
-        self.virtual     = False
+    __slots__ = ("mask",)
+
+    def __init__(self, mask):
+        """__init__ :: Int 'mask' -> None, use make_permission"""
+        self.mask = mask
 
     def set_flags(self, flags):
+        """set_flags :: [Str] -> Permission
 
-        assert set(flags) <= set(["class-read", "no-class-read", 
-                                  "class-write", "no-class-write", 
-                                  "any-read", "no-any-read", 
-                                  "any-write", "no-any-write", 
-                                  "virtual", "no-virtual",
-                                  "read-only", "private"])
-
-        if "class-read" in flags  : self.class_read  = True
-        if "class-write" in flags : self.class_write = True 
-        if "any-read" in flags    : self.any_read    = True 
-        if "any-write" in flags   : self.any_write   = True 
-        if "virtual" in flags     : self.virtual     = True 
-
-        if "no-class-read" in flags  : self.class_read  = False
-        if "no-class-write" in flags : self.class_write = False 
-        if "no-any-read" in flags    : self.any_read    = False 
-        if "no-any-write" in flags   : self.any_write   = False 
-        if "no-virtual" in flags     : self.virtual     = False 
-
-        if "read-only" in flags:
-            self.any_write = False
-            self.class_write = False
-
-        if "private" in flags:
-            self.any_read = False
-            self.any_write = False
+        the permission with `flags` (see `permission_flags`) applied"""
+        assert set(flags) <= set(permission_flags), "invalid permission: %s" % flags
+        set_bits, clear_bits = 0, 0
+        for flag in flags:
+            bits = permission_flags[flag]
+            set_bits |= bits[0]
+            clear_bits |= bits[1]
+        return make_permission((self.mask | set_bits) & ~clear_bits)
 
-    def copy(self):
-        perm = Permission()
-        perm.class_read  = self.class_read 
-        perm.class_write = self.class_write
-        perm.any_read    = self.any_read   
-        perm.any_write   = self.any_write  
-        perm.virtual     = self.virtual    
-        return perm
+    def without(self, bits):
+        """without :: Int -> Permission"""
+        return make_permission(self.mask & ~bits)
+
+    def __reduce__(self):
+        # shared when unpickled too
+        return (make_permission, (self.mask,))
+
+    def __str__(self):
+        names = ["class-read", "class-write", "any-read", "any-write", "virtual"]
+        return " ".join(name for n, name in enumerate(names) if self.mask & (1 << n))
+
+all_permissions = [Permission(mask) for mask in range(32)]
+
+def make_permission(mask):
+    """make_permission :: Int -> Permission"""
+    return all_permissions[mask]
+
+default_permission = make_permission(CLASS_READ | CLASS_WRITE | ANY_READ | ANY_WRITE)
 
 class Variable(object):
+    __slots__ = ("permission", "datatype", "value")
+
     def __init__(self, permission, datatype=None, value=None):
         self.permission = permission
         self.datatype = datatype
@@ -320,14 +777,59 @@ class Variable(object):
         return str(self.value)
 
     def copy(self):
-        return Variable(self.permission.copy(),
-                        self.datatype,
-                        self.value)
+        # the permission can be shared, it never changes
+        return Variable(self.permission, self.datatype, self.value)
 
 class MissingSym(Exception): pass
 class AlreadyDefined(Exception): pass
 class InvalidPermission(Exception): pass
 
+# ----------------------------------------------------------------------------
+# Classes
+#
+# A class (or instance, they are the same) only holds the variables that
+# were defined or set in it. Anything else is found in its `ancestors`,
+# the linearization of its parents worked out once when it is made: each
+# parent then its ancestors, depth first and left to right, with anything 
+# seen twice kept only where it was seen last (so a class always comes 
+# before every class it is made from). Making a class costs nothing for 
+# the variables it inherits.
+#
+# A variable found in an ancestor is used as it is, virtual or not, until
+# the class sets or chmods it, then the class gets its own copy (copy on
+# write). So an instance sees changes to its class until it sets the 
+# variable itself.
+#
+# Each class that has ancestors keeps what it found in them in `found`.
+# Anything added to a class that has been inherited from bumps
+# `class_epoch`, which empties all of those caches.
+#
+# Calling a class, (p1 total), looks the member up in `methods` first, which
+# has each procedure it has found that anyone can read. Changing a variable
+# (define, set or chmod) drops it from the class's own `methods` or, when 
+# the class has been inherited from, bumps `method_epoch` which empties all
+# of them.
+# ----------------------------------------------------------------------------
+
+class_epoch = 0
+method_epoch = 0
+
+def linearize(parents):
+    # linearize :: [LispClass] -> [LispClass]
+    order = []
+    for parent in parents:
+        order.append(parent)
+        order.extend(parent.ancestors)
+
+    seen = set()
+    result = []
+    for cls in reversed(order):
+        if cls not in seen:
+            seen.add(cls)
+            result.append(cls)
+    result.reverse()
+    return result
+
 class LispClass(LispBase):
 
     classid = 0
@@ -341,77 +843,167 @@ class LispClass(LispBase):
         self.finalised = False
         self.internal  = False
 
-        # gather all super-classes and make unique
-        # might as well store the direct parents too
-        self.parents = set(list(parents))
-        self.direct_parents = self.parents
-        for parent in parents:
-            self.parents |= parent.parents
-        
-        # inherit all parents' variables
-        # except virtual
+        self.direct_parents = list(parents)
+        if len(self.direct_parents) == 1:
+            # the usual case, an instance of one class
+            parent = self.direct_parents[0]
+            self.ancestors = [parent] + parent.ancestors
+        else:
+            self.ancestors = linearize(self.direct_parents)
+        for parent in self.direct_parents:
+            parent.inherited = True
+
+        # only what is defined or set here, see `find`
         self.variables = {}
-        for sc in self.parents:
-            for p, v in sc.variables.items():
-                self.variables[p] = v.copy()
-                self.variables[p].permission.virtual = False
+        self.found = None
+        self.found_epoch = -1
+        self.methods = None
+        self.methods_epoch = -1
 
         if debug:
             print self.get_info()
 
+    # set once something is made from this class
+    inherited = False
+
     def get_info(self):
         txt = "make-class %s:\n" % self
         txt += "\tfinalised\t%d\n" % self.finalised
-        txt += "\tparents\t%s\n" % map(str, self.parents)
+        txt += "\tparents\t%s\n" % map(str, self.ancestors)
         txt += "\tvariables\t%s\n" % str(self.variables)
         return txt
 
+    def find(self, var):
+        # find :: Str 'var' -> (LispClass, Variable)
+        # the class the variable is in (self or an ancestor) and the variable
+        variable = self.variables.get(var)
+        if variable is not None:
+            return self, variable
+        if not self.ancestors:
+            raise MissingSym(var)
+
+        if self.found_epoch != class_epoch:
+            self.found = {}
+            self.found_epoch = class_epoch
+        found = self.found.get(var)
+        if found is None:
+            for cls in self.ancestors:
+                variable = cls.variables.get(var)
+                if variable is not None:
+                    found = self.found[var] = (cls, variable)
+                    break
+            else:
+                raise MissingSym(var)
+        return found
+
+    def add_variable(self, var, variable):
+        # add_variable :: Str 'var' -> Variable -> None
+        global class_epoch
+        self.variables[var] = variable
+        if self.inherited:
+            # it may hide a variable that something made from us has found
+            class_epoch += 1
+        self.changed(var)
+
+    def changed(self, var):
+        # changed :: Str 'var' -> None
+        # forget any method `var` was
+        global method_epoch
+        if self.inherited:
+            method_epoch += 1
+        elif self.methods:
+            self.methods.pop(var, None)
+
+    def method(self, var):
+        # method :: Str 'var' -> LispBase
+        # the same as `get`, remembering what it finds if it is a procedure 
+        # that anyone can read
+        if self.methods_epoch != method_epoch:
+            self.methods = {}
+            self.methods_epoch = method_epoch
+        value = self.methods.get(var)
+        if value is not None:
+            return value
+
+        value = self.get(var)
+        owner, variable = self.find(var)
+        if (isinstance(value, LispLambda) and 
+            variable.permission.mask & READ_CHECK == ANY_READ):
+            self.methods[var] = value
+        return value
+
+    def own_variable(self, var):
+        # own_variable :: Str 'var' -> Variable
+        # the variable, copied here first if it is inherited
+        owner, variable = self.find(var)
+        if owner is not self:
+            variable = variable.copy()
+            variable.permission = variable.permission.without(VIRTUAL)
+            self.add_variable(var, variable)
+        return variable
+
     def define(self, var, datatype=None, value=None):
         # define :: Str 'var' -> Type 'type' -> None
         if self.finalised: raise InvalidPermission("finalised:" + var)
-        if var in self.variables: raise AlreadyDefined(var)
+        try:
+            # defined here or inherited
+            self.find(var)
+        except MissingSym:
+            pass
+        else:
+            raise AlreadyDefined(var)
 
         # give the default permission and no value
-        permission = Permission()
-        variable = Variable(permission, datatype, value)
-        self.variables[var] = variable
+        variable = Variable(default_permission, datatype, value)
+        self.add_variable(var, variable)
+        name_procedure(value, var)
 
     def set(self, var, value):
         # set :: Str 'var' -> LispBase 'value' -> None
-        if var not in self.variables: raise MissingSym(var)
-
-        # check permissions
-        permissions = self.variables[var].permission
-        if permissions.virtual: raise InvalidPermission(var)
-        if not permissions.any_write:
-            if not (self.internal and permissions.class_write):
-                raise InvalidPermission(var)
-        
+        variable = self.variables.get(var)
+        if variable is None or variable.permission.mask & WRITE_CHECK != ANY_WRITE:
+            # inherited, or not writable by just anyone
+            owner, variable = self.find(var)
+            if variable.permission.mask & WRITE_CHECK != ANY_WRITE:
+                self.check_access(var, owner, variable.permission, CLASS_WRITE, ANY_WRITE)
+            if owner is not self:
+                variable = self.own_variable(var)
 
         # todo: check datatypes match
-        self.variables[var].value = value
+        variable.value = value
+        if self.inherited or self.methods:
+            self.changed(var)
 
     def get(self, var):
         # get :: Str 'var' -> LispBase
-        if var not in self.variables: raise MissingSym(var)
-
-        # check permissions
-        permissions = self.variables[var].permission
-        if permissions.virtual: raise InvalidPermission(var)
-        if not permissions.any_read:
-            if not (self.internal and permissions.class_read):
-                raise InvalidPermission(var)
-
-        value = self.variables[var].value
+        variable = self.variables.get(var)
+        if variable is None or variable.permission.mask & READ_CHECK != ANY_READ:
+            # inherited, or not readable by just anyone
+            owner, variable = self.find(var)
+            if variable.permission.mask & READ_CHECK != ANY_READ:
+                self.check_access(var, owner, variable.permission, CLASS_READ, ANY_READ)
+
+        value = variable.value
         assert value is not None, "%s not set" % var
         return value
 
     def chmod(self, var, flags):
         # chmod  :: Str 'var' -> [Str] 'flags' -> None
         if self.finalised: raise InvalidPermission("finalised:" + var)
-        if var not in self.variables: raise MissingSym(var)
         # todo: should only those with write permission be able to set this?
-        self.variables[var].permission.set_flags(flags)
+        variable = self.own_variable(var)
+        variable.permission = variable.permission.set_flags(flags)
+        self.changed(var)
+
+    def check_access(self, var, owner, permission, class_bit, any_bit):
+        # check_access :: Str -> LispClass -> Permission -> Int -> Int -> None
+        # the checks `get` and `set` skip for a variable anyone can use,
+        # `class_bit` and `any_bit` are the read or the write ones
+        mask = permission.mask
+        if mask & VIRTUAL and owner is self: raise InvalidPermission(var)
+        if not mask & any_bit:
+            if not (self.internal and mask & class_bit):
+                raise InvalidPermission(var)
 
     def call(self, func, args, env):
         # call :: LispBase 'func' -> LispPair 'args' -> LispBase
@@ -434,13 +1026,31 @@ class LispClass(LispBase):
             print "call-class %s:" % self
             print "\targs", args
 
-        newenv = Environment(['self'], [self], env)
-
+        # `self` is bound in a call frame of its own, it needs no permissions
+        if isinstance(func, LispLambda) and not func.macro and not dynamic_scope:
+            # the arguments are evaluated where the call is made, the body 
+            # sees `self` between its closure and its parameters
+            evaled_args = eval_list(args, env)
+            newenv = Frame(self_slots, [self], func.env)
+            call = TailCall(func, func.frame(evaled_args, newenv))
+        else:
+            newenv = Frame(self_slots, [self], env)
+            call = None
+
+        # a method can call another method of self, which must not end its 
+        # access when it returns
+        internal = self.internal
+        if call_stack and call_stack[-1] is self:
+            # the method takes our place on the stack (which whoever pushed
+            # us pops), so (stack) and the profiler see it
+            call_stack[-1] = func
         try:
             self.internal = True
-            result = func(args, newenv)
+            if call is None:
+                call = func(args, newenv)
+            result = trampoline(call)
         finally:
-            self.internal = False
+            self.internal = internal
         return result
 
 
@@ -448,19 +1058,29 @@ class LispClass(LispBase):
         """__call__ :: SchemePair -> Environment"""
 
         assert isinstance(first(args), LispSymbol)
-        value = self.get(first(args).name)
+        value = self.method(first(args).name)
         if callable(value):
             return self.call(value, rest(args), env)
         else:
             assert rest(args) is nil
             return value
 
+    def __getstate__(self):
+        # what was found is only a cache, it can be found again
+        state = self.__dict__.copy()
+        state["found"] = None
+        state["found_epoch"] = -1
+        return state
+
     def scm_eval(self, env): return mksym(str(self))
     def __str__(self): return "<#class-%d#>" % self.id
     def __eq__(self, other): return self is other
 
 class_base = LispClass(set())
 
+# the layout of the call frame that binds `self` for a method call
+self_slots = {"self": 0}
+
 
 # ----------------------------------------------------------------------------
 
@@ -482,7 +1102,7 @@ class Environment(LispClass):
         # to Lisp as a class.
 
         if parent:
-            assert(isinstance(parent, Environment))
+            assert(isinstance(parent, (Environment, Frame)))
             super(Environment, self).define("__parent__", None, parent)
             super(Environment, self).chmod("__parent__", 
                                            ["no-class-read", "no-class-write",
@@ -501,15 +1121,59 @@ class Environment(LispClass):
         else:
             return None
 
+    def detach(self):
+        # func detach :: None -> None
+        # remove the link to the parent
+        del self.variables["__parent__"]
+        invalidate_lookups()
+
+    def find_variable(self, var):
+        # func find_variable :: Str 'var' -> Optional Variable
+        # the Variable that `get` would read, without checking permissions
+        env = self
+        while env is not None:
+            if type(env) is Frame:
+                env = env.outer
+            elif var in env.variables:
+                return env.variables[var]
+            else:
+                env = env.parent()
+        return None
+
+    def define(self, var, datatype=None, value=None):
+        # func define :: Str 'var' -> Type 'type' -> LispBase 'value' -> None
+        super(Environment, self).define(var, datatype, value)
+        # this may shadow a Variable that some LookupSite has cached
+        invalidate_lookups()
+
     def get(self, var):
         # func get :: Str 'var' -> LispBase
         if var in self.variables:
             return super(Environment, self).get(var)
         elif self.parent() is None:
+            if self.autoload(var):
+                return super(Environment, self).get(var)
             raise MissingSym(var)
         else:
             return self.parent().get(var)
 
+    # {Str: Environment -> None} the names that can be defined in this
+    # environment when they are first looked up, by what defines them
+    autoloads = None
+
+    def autoload(self, var):
+        # func autoload :: Str 'var' -> Bool
+        # define `var` (and whatever is defined with it) if it can be
+        if self.autoloads is None or var not in self.autoloads:
+            return False
+
+        load = self.autoloads[var]
+        for name, other in self.autoloads.items():
+            if other is load:
+                del self.autoloads[name]
+        load(self)
+        return var in self.variables
+
     def set(self, var, val):
         # func set :: Str 'var' -> LispBase 'val' -> None
         if var in self.variables:
@@ -522,6 +1186,7 @@ class Environment(LispClass):
     def chmod(self, var, flags):
         # func chmod :: Str 'var' -> [Str] 'flags' -> None
         if var in self.variables:
+            invalidate_lookups()
             return super(Environment, self).chmod(var, flags)
         elif self.parent() is None:
             raise MissingSym(var)
@@ -530,20 +1195,173 @@ class Environment(LispClass):
 
     def __str__(self):
         # func __str__ :: None -> Str
-        ret = "PRINT ENV\n"
-        for sym, val in self.variables.items():
-            if sym != "__parent__":
-                ret += sym + " = " + str(val) + "\n"
-        ret += "---\n"
-        if self.parent() is not None:
-            ret += str(self.parent())
+        from printer import to_string
+        return to_string(self)
+
+
+
+
+# ----------------------------------------------------------------------------
+
+class Frame(object):
+    """The bindings made by calling a LispLambda. 
+
+    A full Environment is a LispClass, each binding would need a Variable 
+    and a Permission. A call frame only needs the argument values: `slots` 
+    maps each parameter name to its position in `values` and is shared by 
+    every call to the same LispLambda. `define` inside the body goes in 
+    `extra` which is only made when needed."""
+
+    __slots__ = ("slots", "values", "outer", "extra", "top")
+
+    def __init__(self, slots, values, outer):
+        # init :: {Str: Int} -> [LispBase] -> Environment -> Frame
+        self.slots = slots
+        self.values = values
+        self.outer = outer
+        self.extra = None
+
+        # the first environment past all the call frames
+        if type(outer) is Frame:
+            self.top = outer.top
         else:
-            ret += "===\n"
-        
-        return ret
+            self.top = outer
+
+    def parent(self):
+        return self.outer
+
+    def get(self, var):
+        # func get :: Str 'var' -> LispBase
+        env = self
+        while type(env) is Frame:
+            n = env.slots.get(var)
+            if n is not None:
+                return env.values[n]
+            if env.extra is not None and var in env.extra:
+                return env.extra[var]
+            env = env.outer
+        if env is None:
+            raise MissingSym(var)
+        return env.get(var)
+
+    def set(self, var, val):
+        # func set :: Str 'var' -> LispBase 'val' -> None
+        env = self
+        while type(env) is Frame:
+            n = env.slots.get(var)
+            if n is not None:
+                env.values[n] = val
+                return
+            if env.extra is not None and var in env.extra:
+                env.extra[var] = val
+                return
+            env = env.outer
+        if env is None:
+            raise MissingSym(var)
+        return env.set(var, val)
+
+    def define(self, var, datatype=None, value=None):
+        # define :: Str 'var' -> Type 'type' -> LispBase 'value' -> None
+        if var in self.slots: raise AlreadyDefined(var)
+        if self.extra is None:
+            self.extra = {}
+        elif var in self.extra: 
+            raise AlreadyDefined(var)
+        self.extra[var] = value
+        frame_names.add(var)
+        name_procedure(value, var)
+
+    def chmod(self, var, flags):
+        # func chmod :: Str 'var' -> [Str] 'flags' -> None
+        if var in self.slots or (self.extra is not None and var in self.extra):
+            raise InvalidPermission("call frames have no permissions: " + var)
+        if self.outer is None:
+            raise MissingSym(var)
+        return self.outer.chmod(var, flags)
+
+    def items(self):
+        # items :: None -> [(Str, LispBase)]
+        result = [(name, self.values[n]) for name, n in self.slots.items()]
+        if self.extra is not None:
+            result.extend(self.extra.items())
+        return result
+
+    def __call__(self, args, env):
+        """__call__ :: SchemePair -> Environment"""
+        assert isinstance(first(args), LispSymbol)
+        value = self.get(first(args).name)
+        if callable(value):
+            return value(rest(args), env)
+        else:
+            assert rest(args) is nil
+            return value
+
+    def scm_eval(self, env): return mksym(str(self))
+
+    def __str__(self):
+        # func __str__ :: None -> Str
+        from printer import to_string
+        return to_string(self)
+
+    def __eq__(self, other): return self is other
+
+# ----------------------------------------------------------------------------
+# Inline caches
+#
+# Looking up a global such as `+` from deep inside a recursion walks every 
+# frame on the way. Instead each place a symbol is referenced (the pair that
+# holds it for the tree walker, the closure for the compiler) has a 
+# LookupSite that remembers the Variable it found last time. 
+#
+# A name that has never been bound in a call frame (see `frame_names`) can 
+# only be in an Environment, so from the same `top` (the environment past the 
+# call frames) it will find the same Variable until something is defined, 
+# chmod-ed or detached in an Environment. Those bump the `epoch` which makes 
+# every LookupSite look again.
+# ----------------------------------------------------------------------------
 
+frame_names = set(["self"])
+epoch = 0
 
+def invalidate_lookups():
+    global epoch
+    epoch += 1
 
+class LookupSite(object):
+    """Where a symbol is referenced, remembers what it found last time"""
+
+    __slots__ = ("name", "top", "variable", "epoch")
+
+    def __init__(self, name):
+        self.name = name
+        self.top = None
+        self.variable = None
+        self.epoch = -1
+
+    def lookup(self, env):
+        # lookup :: Environment -> LispBase
+        name = self.name
+        if name in frame_names:
+            return env.get(name)
+
+        if type(env) is Frame:
+            top = env.top
+        else:
+            top = env
+
+        if top is self.top and self.epoch == epoch:
+            return self.variable.value
+
+        # do it the long way (which checks permissions and raises the errors)
+        # then remember where it came from if it is always readable.
+        value = env.get(name)
+        variable = top.find_variable(name)
+        if (variable.value is value and 
+            variable.permission.mask & READ_CHECK == ANY_READ):
+            self.top = top
+            self.variable = variable
+            self.epoch = epoch
+        return value
 
 #------------------------------u------------------------------------------------
 
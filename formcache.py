@@ -0,0 +1,186 @@
+import gc
+import os
+import sys
+import marshal
+import hashlib
+
+from datatypes import nil, true, false, mksym, LispPair, LispSymbol, LispInteger, LispString, make_integer
+from lex import tokenize
+from parse import parse
+
+# -----------------------------------------------------------------------------
+# Form cache
+#
+# Reading a source file through the lexer and parser is most of the time it
+# takes to load it. The parsed top level forms of `x.scm` are kept in
+# `x.scmc` and used instead while the source is the same (by the sha1 of its
+# contents) and the cache was made by the same version of this format and of
+# python (marshal's format can change).
+#
+# The forms are stored as a flat postfix program, one character per value,
+# with the symbols, numbers and strings it needs in a separate list:
+#
+#   s - push the symbol named by the next constant
+#   i - push the next constant as a LispInteger
+#   q - push the next constant as a LispString
+#   n, t, f - push nil, true or false
+#   p - pop rest and first, push the pair of them
+#
+# i.e. (a . 3) is "sip" with the constants ["a", 3]. Neither writing it nor
+# reading it back recurses, so any nesting is fine.
+#
+# example:
+#   sexps = read_forms("prelude.scm")
+# -----------------------------------------------------------------------------
+
+FORMAT_VERSION = 1
+extension = "c"
+
+# `enabled` can be cleared to always parse the source (and write nothing)
+enabled = True
+hits = 0
+misses = 0
+
+def cache_key(source):
+    # cache_key :: Str -> (Int, Str, Str)
+    return (FORMAT_VERSION, sys.version, hashlib.sha1(source).hexdigest())
+
+def encode(sexps):
+    # encode :: [LispBase] -> (Str, [Str | Int])
+    ops = []
+    consts = []
+
+    # visit each node then its rest then its first, reversed that is first,
+    # rest, node: postfix order.
+    todo = list(sexps)
+    nodes = []
+    while todo:
+        sexp = todo.pop()
+        nodes.append(sexp)
+        if isinstance(sexp, LispPair):
+            todo.append(sexp.first)
+            todo.append(sexp.rest)
+
+    for sexp in reversed(nodes):
+        if isinstance(sexp, LispPair):
+            ops.append("p")
+        elif isinstance(sexp, LispSymbol):
+            ops.append("s")
+            consts.append(sexp.name)
+        elif isinstance(sexp, LispInteger):
+            ops.append("i")
+            consts.append(sexp.num)
+        elif isinstance(sexp, LispString):
+            ops.append("q")
+            consts.append(sexp.text)
+        elif sexp is nil:
+            ops.append("n")
+        elif sexp is true:
+            ops.append("t")
+        elif sexp is false:
+            ops.append("f")
+        else:
+            raise Exception("cannot cache %s" % sexp)
+
+    return "".join(ops), consts
+
+def decode(ops, consts):
+    # decode :: Str -> [Str | Int] -> [LispBase]
+
+    # nothing made here can be part of a cycle, so there is no need for 
+    # the garbage collector to keep looking at it (most of the time taken
+    # for a big file)
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        return decode_ops(ops, consts)
+    finally:
+        if collecting:
+            gc.enable()
+
+def decode_ops(ops, consts):
+    # decode_ops :: Str -> [Str | Int] -> [LispBase]
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    const = iter(consts).next
+
+    for op in ops:
+        if op == "p":
+            rest = pop()
+            stack[-1] = LispPair(stack[-1], rest)
+        elif op == "s":
+            push(mksym(const()))
+        elif op == "i":
+            push(make_integer(const()))
+        elif op == "q":
+            push(LispString(const()))
+        elif op == "n":
+            push(nil)
+        elif op == "t":
+            push(true)
+        elif op == "f":
+            push(false)
+        else:
+            raise Exception("invalid form cache op: %s" % op)
+
+    # what is left is each of the forms
+    return stack
+
+def read_forms(path):
+    # read_forms :: Str -> [LispBase]
+    # the parsed top level forms of the file at `path`
+    global hits, misses
+
+    with open(path, "rb") as stream:
+        source = stream.read()
+    if not enabled:
+        return list(parse(tokenize(source)))
+
+    key = cache_key(source)
+    cache_path = path + extension
+    try:
+        with open(cache_path, "rb") as stream:
+            cached_key, ops, consts = marshal.load(stream)
+        if cached_key == key:
+            hits += 1
+            return decode(ops, consts)
+    except (EnvironmentError, EOFError, ValueError, TypeError):
+        # not there or not one of ours, make it again
+        pass
+
+    misses += 1
+    sexps = list(parse(tokenize(source)))
+    write_cache(cache_path, key, sexps)
+    return sexps
+
+def write_cache(cache_path, key, sexps):
+    # write_cache :: Str -> (Int, Str, Str) -> [LispBase] -> None
+    # written to a new file then renamed so nobody reads half of it, it does
+    # not matter if it can't be written at all
+    ops, consts = encode(sexps)
+    temp_path = "%s.%d" % (cache_path, os.getpid())
+    try:
+        with open(temp_path, "wb") as stream:
+            marshal.dump((key, ops, consts), stream)
+        os.rename(temp_path, cache_path)
+    except EnvironmentError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+# -----------------------------------------------------------------------------
+
+def test():
+    print "testing: formcache"
+    text = """(define (f x . y) '(x "s t r" -12 nil true false ()))
+              `(a ,b) (((deep))) 1234567890"""
+    sexps = list(parse(tokenize(text)))
+    ops, consts = encode(sexps)
+    again = decode(ops, consts)
+    assert map(str, again) == map(str, sexps)
+    assert again[0].first is mksym("define")
+    assert decode(*encode([])) == []
+
+    size = 20000
+    deep = list(parse(tokenize("(" * size + ")" * size)))
+    assert str(decode(*encode(deep))[0]) == str(deep[0])
@@ -1,7 +1,17 @@
-from datatypes import nil, true, false, mksym, cons, from_list, to_list, LispSymbol, LispLambda, LispPair, first, rest, LispInteger, LispClass, class_base, Environment, LispString, get_stack
+import os
+import sys
+import operator
+import itertools
+import datatypes
+from datatypes import nil, true, false, mksym, cons, from_list, to_list, LispSymbol, LispVector, make_vector, LispHashTable, LispLambda, LispPair, first, rest, LispInteger, make_integer, LispClass, class_base, Environment, LispString, get_stack, tail_eval, trampoline, Continuation, ContinuationInvoked, call_stack, eval_list, name_procedure
 
 from lex import tokenize
 from parse import parse
+from printer import write
+from formcache import read_forms
+from profiler import profile
+import counters
+from image import save_image, load_image
 
 # -----------------------------------------------------------------------------
 # QUOTE
@@ -129,9 +139,9 @@ def if_func(args, env):
     result = predicate.scm_eval(env)
 
     if result is true:
-        return consequence.scm_eval(env)
+        return tail_eval(consequence, env)
     else:
-        return alternative.scm_eval(env)
+        return tail_eval(alternative, env)
 
 # -----------------------------------------------------------------------------
 # LAMBDA
@@ -142,6 +152,8 @@ def if_func(args, env):
 # make a procedure, <parameters> can be a symbol, proper-list or 
 # dotted-list. when evaluated returns the value of (eval <bodyN>) 
 # in an environment where <parameters> are bound to the arguments.
+# That environment extends the one the lambda was made in (or the one it is
+# called from if `datatypes.dynamic_scope` is set).
 # 
 # example:
 #   #FUN <= (lambda (x) (+ 3 x))
@@ -154,7 +166,7 @@ def lambda_func(args, env):
     param = first(args)
     body = rest(args)
 
-    return LispLambda(param, body)
+    return LispLambda(param, body, False, env)
 
 # -----------------------------------------------------------------------------
 # BEGIN 
@@ -176,9 +188,9 @@ def begin_func(args, env):
     assert args[-1] is nil, "invalid args for 'begin': %s" % args
     assert len(args) >= 2, "invalid args for 'begin': %s" % args
 
-    for arg in args[:-1]:
-        result = arg.scm_eval(env)
-    return result
+    for arg in args[:-2]:
+        arg.scm_eval(env)
+    return tail_eval(args[-2], env)
 
 
 # -----------------------------------------------------------------------------
@@ -252,6 +264,9 @@ def class_set_func(args, env):
     # print "value", value, evaled_value
 
     evaled_class.set(evaled_var, evaled_value)
+    if isinstance(class_name, LispSymbol):
+        # a method is known as <class-name>.<var-name>
+        name_procedure(evaled_value, class_name.name + "." + evaled_var)
     return nil
 
 # -----------------------------------------------------------------------------
@@ -322,7 +337,7 @@ def macro_func(args, env):
     param = first(args)
     body = rest(args)
 
-    return LispLambda(param, body, True)
+    return LispLambda(param, body, True, env)
 
 # -----------------------------------------------------------------------------
 # quasiquote
@@ -400,12 +415,66 @@ def quasiquote_func(args, env):
 
         return inner_qq(arg)
 
+# -----------------------------------------------------------------------------
+# call/cc
+# 
+# (call/cc <proc>)
+# 
+# Call <proc> with the current continuation. Under the tree walker and the
+# compiler the continuation can only be used to escape (return early from the
+# call/cc), the machine evaluator (see machine.py) can resume it any number 
+# of times, even after the call/cc has returned.
+# 
+# example:
+#   3  <= (+ 1 (call/cc (lambda (k) 2)))
+#   42 <= (call/cc (lambda (k) (+ 1 (k 42))))
+#
+# -----------------------------------------------------------------------------
+
+def callcc_func(args, env):
+    assert rest(args) is nil
+    proc = first(args).scm_eval(env)
+
+    continuation = Continuation()
+    depth = len(call_stack)
+    try:
+        return call_procedure(proc, [continuation], env)
+    except ContinuationInvoked, invoked:
+        if invoked.continuation is not continuation: raise
+        # the calls we escaped from never got to pop themselves
+        del call_stack[depth:]
+        return invoked.value
+
 
 
 
 # -----------------------------------------------------------------------------
 # -----------------------------------------------------------------------------
 # -----------------------------------------------------------------------------
+# Evaluators
+#
+# There is more than one way to run a sexp. The tree walker is the `scm_eval`
+# method on each datatype, others (see compiler.py) register themselves here 
+# by name. Everything that evaluates top level forms (the repl, `include`, 
+# `import`) goes through `evaluate` so that they use the selected one.
+# -----------------------------------------------------------------------------
+
+def tree_eval(sexp, env):
+    return sexp.scm_eval(env)
+
+evaluators = {"tree": tree_eval}
+current_evaluator = tree_eval
+
+def set_evaluator(name):
+    # set_evaluator :: Str 'name' -> None
+    global current_evaluator
+    current_evaluator = evaluators[name]
+
+def evaluate(sexp, env):
+    # evaluate :: LispBase -> Environment -> LispBase
+    return current_evaluator(sexp, env)
+
+# -----------------------------------------------------------------------------
 
 def read_file(stream, env):
 
@@ -420,30 +489,156 @@ def read_file(stream, env):
         # functions in out imported class.
         env = Environment([], [], basic_environment)
 
-    for sexp in parse(tokenize(iter(stream))):
-        sexp.scm_eval(env)
+    if isinstance(stream, file) and os.path.isfile(stream.name):
+        # the forms may be cached (see formcache.py)
+        sexps = read_forms(stream.name)
+    else:
+        sexps = parse(tokenize(stream))
+
+    for sexp in sexps:
+        evaluate(sexp, env)
 
-    # I guess we should kill the parent if there was no 
-    # env before. No need having thingslike `quote` in there.
     if no_env:
-        del env.variables["__parent__"]
+        finish_module(env)
 
     # as the environment is a class we can just return it
     return env
 
-def import_func(args, env):
+def finish_module(env):
+    # I guess we should kill the parent if there was no 
+    # env before. No need having thingslike `quote` in there.
+    # (Unless the procedures defined in the file close over it, they still
+    # need the parent to find `quote`.)
+    if datatypes.dynamic_scope:
+        env.detach()
+
+# -----------------------------------------------------------------------------
+# Modules
+#
+# (import <file-name>)
+# (include <file-name>)
+# (reload <file-name>)
+#
+# Each file is only read once. `module_cache` keeps a Module for each file, 
+# by its real path, which is used again for as long as the file has the same 
+# modification time and size:
+#
+#   import  - returns the environment made by evaluating the file on its 
+#             own, the same one each time
+#   include - evaluates the file's forms in the current environment, they
+#             are only tokenized and parsed once
+#   reload  - imports the file again whether it has changed or not
+#
+# A file that imports itself (maybe through others) gets its environment
+# as it is so far.
+#
+# example:
+#   nil   <= (define prelude (import "prelude.scm"))
+#   true  <= (is? prelude (import "prelude.scm"))
+#   false <= (is? prelude (reload "prelude.scm"))
+# -----------------------------------------------------------------------------
+
+class Module(object):
+    def __init__(self, path, stamp):
+        self.path = path
+        self.stamp = stamp
+        self.sexps = None
+        self.env = None
+
+    def forms(self):
+        # forms :: None -> [LispBase]
+        if self.sexps is None:
+            self.sexps = read_forms(self.path)
+        return self.sexps
+
+class ModuleCache(object):
+
+    def __init__(self):
+        self.modules = {}
+        self.clear_stats()
+
+    def clear_stats(self):
+        self.hits = 0
+        self.loads = 0
+        self.reloads = 0
+
+    def find(self, file_name):
+        # find :: Str -> Module
+        # the Module for the file as it is now
+        path = os.path.realpath(file_name)
+        info = os.stat(path)
+        stamp = (info.st_mtime, info.st_size)
+
+        module = self.modules.get(path)
+        if module is None or module.stamp != stamp:
+            module = self.modules[path] = Module(path, stamp)
+        return module
+
+    def import_module(self, file_name, reload=False):
+        # import_module :: Str -> Bool -> Environment
+        module = self.find(file_name)
+        if module.env is not None and not reload:
+            self.hits += 1
+            return module.env
+
+        if reload:
+            self.reloads += 1
+            module = self.modules[module.path] = Module(module.path, module.stamp)
+        self.loads += 1
+
+        env = module.env = Environment([], [], basic_environment)
+        try:
+            for sexp in module.forms():
+                evaluate(sexp, env)
+        except:
+            # try again next time
+            del self.modules[module.path]
+            raise
+
+        finish_module(env)
+        return env
+
+    def include(self, file_name, env):
+        # include :: Str -> Environment -> None
+        module = self.find(file_name)
+        if module.sexps is not None:
+            self.hits += 1
+        else:
+            self.loads += 1
+        for sexp in module.forms():
+            evaluate(sexp, env)
+
+    def stats(self):
+        # stats :: None -> LispPair
+        return from_list([cons(mksym(name), make_integer(value)) for name, value in 
+                          [("hits", self.hits), ("loads", self.loads), 
+                           ("reloads", self.reloads)]] + [nil])
+
+module_cache = ModuleCache()
+
+def file_name_arg(args):
     file_name = first(args)
     assert rest(args) is nil
     assert isinstance(file_name, LispString)
-    return read_file(open(file_name.text), None)
+    return file_name.text
+
+def import_func(args, env):
+    return module_cache.import_module(file_name_arg(args))
+
+def reload_func(args, env):
+    return module_cache.import_module(file_name_arg(args), True)
 
 def include_func(args, env):
-    file_name = first(args)
-    assert rest(args) is nil
-    assert isinstance(file_name, LispString)
-    read_file(open(file_name.text), env)
+    module_cache.include(file_name_arg(args), env)
+    return nil
+
+def save_image_func(args, env):
+    save_image(env, file_name_arg(args))
     return nil
 
+def load_image_func(args, env):
+    return load_image(file_name_arg(args))
+
 # -----------------------------------------------------------------------------
 
 def env_func(args, env):
@@ -452,32 +647,293 @@ def env_func(args, env):
 # -----------------------------------------------------------------------------
 
 def predefined_function(inputfunction):
-    def func(args, env):
-        evaled_args = [arg.scm_eval(env) for arg in to_list(args)][:-1]
+    def primitive(*evaled_args):
         result = inputfunction(*evaled_args)
         if result is None: result = nil
         return result
+
+    def func(args, env):
+        evaled_args = eval_list(args, env)
+        return primitive(*evaled_args)
+
+    # evaluators that have already evaluated the arguments can call 
+    # the primitive directly
+    func.primitive = primitive
     return func
 
+def call_procedure(func, evaled_args, env):
+    # call_procedure :: LispBase -> [LispBase] -> Environment -> LispBase
+    # call `func` with arguments that have already been evaluated
+
+    if isinstance(func, LispLambda) and not func.macro:
+        return trampoline(func.apply(list(evaled_args), env))
+
+    primitive = getattr(func, "primitive", None)
+    if primitive is not None:
+        return primitive(*evaled_args)
+
+    if isinstance(func, Continuation):
+        assert len(evaled_args) == 1, "a continuation takes one value"
+        raise ContinuationInvoked(func, evaled_args[0])
+
+    # anything else evaluates its own arguments so quote them
+    quoted = [from_list([mksym("quote"), arg, nil]) for arg in evaled_args]
+    return trampoline(func(from_list(quoted + [nil]), env))
+
 def to_scm_bool(x):
     if x: return true
     else: return false
 
-def two_integer_function(inputfunction):
+# -----------------------------------------------------------------------------
+# Arithmetic and comparisons
+#
+# (+ 1 2 3)   => 6        (+)   => 0
+# (- 10 1 2)  => 7        (- 3) => -3
+# (< 1 2 3)   => true     (< 1 3 2) => false
+#
+# Each takes any number of integers. Arithmetic folds `combine` over them 
+# from the left, one argument gives `unary` of it and none gives `identity`.
+# A comparison is true when `compare` holds for each neighbouring pair.
+#
+# Most calls have two arguments, they are checked for first. Otherwise 
+# `func` evaluates the arguments one at a time as it goes, without a list
+# of them, the primitive is given them already evaluated.
+# -----------------------------------------------------------------------------
+
+def integer_arg(value):
+    # integer_arg :: LispBase -> Int
+    assert isinstance(value, LispInteger), "not an integer: %s" % value
+    return value.num
+
+def arithmetic_function(combine, identity=None, unary=None):
+    def primitive(*evaled_args):
+        if len(evaled_args) == 2:
+            a, b = evaled_args
+            return make_integer(combine(integer_arg(a), integer_arg(b)))
+
+        if not evaled_args:
+            assert identity is not None, "needs at least one argument"
+            return make_integer(identity)
+
+        result = integer_arg(evaled_args[0])
+        if len(evaled_args) == 1:
+            return make_integer(unary(result) if unary else result)
+        for arg in evaled_args[1:]:
+            result = combine(result, integer_arg(arg))
+        return make_integer(result)
+
     def func(args, env):
-        evaled_args = [arg.scm_eval(env) for arg in to_list(args)][:-1]
-
-        assert len(evaled_args) == 2
-        assert isinstance(evaled_args[0], LispInteger)
-        assert isinstance(evaled_args[1], LispInteger)
-        result = inputfunction(evaled_args[0].num, evaled_args[1].num)
-        if isinstance(result, int):
-            result = LispInteger(result)
+        if args is nil:
+            return primitive()
+
+        result = integer_arg(args.eval_first(env))
+        args = args.rest
+        if type(args) is LispPair and args.rest is nil:
+            return make_integer(combine(result, integer_arg(args.eval_first(env))))
+        if args is nil:
+            return make_integer(unary(result) if unary else result)
+
+        while type(args) is LispPair:
+            result = combine(result, integer_arg(args.eval_first(env)))
+            args = args.rest
+        assert args is nil, "invalid arguments: %s" % args
+        return make_integer(result)
+
+    func.primitive = primitive
+    return func
+
+def comparison_function(compare):
+    def primitive(*evaled_args):
+        if len(evaled_args) == 2:
+            a, b = evaled_args
+            return true if compare(integer_arg(a), integer_arg(b)) else false
+
+        assert evaled_args, "needs at least one argument"
+        nums = map(integer_arg, evaled_args)
+        for n in xrange(len(nums) - 1):
+            if not compare(nums[n], nums[n + 1]):
+                return false
+        return true
+
+    def func(args, env):
+        assert type(args) is LispPair, "needs at least one argument"
+
+        a = integer_arg(args.eval_first(env))
+        args = args.rest
+        if type(args) is LispPair and args.rest is nil:
+            return true if compare(a, integer_arg(args.eval_first(env))) else false
+
+        # every argument is evaluated, even once the answer is known
+        result = true
+        while type(args) is LispPair:
+            b = integer_arg(args.eval_first(env))
+            if not compare(a, b):
+                result = false
+            a = b
+            args = args.rest
+        assert args is nil, "invalid arguments: %s" % args
         return result
+
+    func.primitive = primitive
     return func
 
-def display(text):
-    print text
+# -----------------------------------------------------------------------------
+# (apply <procedure> <arg> ... <list>)
+#
+# Call the procedure with the arguments followed by the elements of the list,
+# i.e. (apply + 1 2 '(3 4)) is (+ 1 2 3 4).
+# -----------------------------------------------------------------------------
+
+def apply_func(args, env):
+    evaled_args = eval_list(args, env)
+    assert len(evaled_args) >= 2, "apply needs a procedure and a list"
+
+    func = evaled_args[0]
+    spread = to_list(evaled_args[-1])
+    assert spread[-1] is nil, "apply needs a list, not %s" % evaled_args[-1]
+    return call_procedure(func, evaled_args[1:-1] + spread[:-1], env)
+
+# -----------------------------------------------------------------------------
+# Vectors (see LispVector)
+#
+# (vector 1 2 3)             => #( 1 2 3 )
+# (make-vector 3 0)          => #( 0 0 0 )
+# (list->vector '(1 2 3))    (vector->list v)
+# (vector-length v)          (vector-ref v 0)        (vector-set! v 0 7)
+# (vector-sum v)             (vector-dot v w)
+# (vector+ v w)  (vector- v 1)  (vector* v 2)   - element-wise, with a
+#                                                 vector or a number
+# (vector-map f v ...)       => a vector of (f (vector-ref v i) ...)
+#
+# vector-map with +, - or * is element-wise arithmetic, anything else is
+# called once per element.
+# -----------------------------------------------------------------------------
+
+def vector_arg(value):
+    # vector_arg :: LispBase -> LispVector
+    assert isinstance(value, LispVector), "not a vector: %s" % value
+    return value
+
+def operand_arg(value):
+    # operand_arg :: LispBase -> LispVector | Int
+    if isinstance(value, LispVector):
+        return value
+    return integer_arg(value)
+
+def list_to_vector(lst):
+    nums = []
+    while isinstance(lst, LispPair):
+        nums.append(integer_arg(lst.first))
+        lst = lst.rest
+    assert lst is nil, "not a list: %s" % lst
+    return make_vector(nums)
+
+def vector_to_list(vec):
+    return from_list(map(make_integer, vector_arg(vec).nums()) + [nil])
+
+def make_vector_func(length, fill):
+    return make_vector(itertools.repeat(integer_arg(fill), integer_arg(length)))
+
+def vector_set(vec, n, value):
+    vector_arg(vec).set(integer_arg(n), integer_arg(value))
+
+def elementwise_function(op):
+    def elementwise(vec, other):
+        return vector_arg(vec).combine(op, operand_arg(other))
+    return predefined_function(elementwise)
+
+def vector_map_func(args, env):
+    evaled_args = eval_list(args, env)
+    assert len(evaled_args) >= 2, "vector-map needs a procedure and a vector"
+    func = evaled_args[0]
+    vectors = map(vector_arg, evaled_args[1:])
+
+    op = elementwise_operators.get(func)
+    if op is not None and len(vectors) == 2:
+        return vectors[0].combine(op, vectors[1])
+
+    def call(*nums):
+        return integer_arg(call_procedure(func, map(make_integer, nums), env))
+    return make_vector(itertools.imap(call, *[vec.nums() for vec in vectors]))
+
+# -----------------------------------------------------------------------------
+# Hash tables (see LispHashTable)
+#
+# (define h (make-hash-table))
+# (hash-set! h 'a 1)
+# (hash-ref h 'a)            => 1
+# (hash-ref h 'b 0)          => 0, the default when b is not there
+# (hash-remove! h 'a)        (hash-count h)
+# (hash-keys h)              (hash->list h)    => ( ( key . value ) ... )
+# (hash-for-each h f)        calls (f key value) for each one
+# -----------------------------------------------------------------------------
+
+def table_arg(value):
+    # table_arg :: LispBase -> LispHashTable
+    assert isinstance(value, LispHashTable), "not a hash table: %s" % value
+    return value
+
+def key_arg(value):
+    # key_arg :: LispBase -> LispBase
+    # anything but a vector (or a pair holding one) can be a key, see the
+    # hashing notes at LispBase
+    try:
+        hash(value)
+        hashable = True
+    except TypeError:
+        hashable = False
+    assert hashable, "cannot be a hash table key: %s" % value
+    return value
+
+def hash_ref(table, key, default=None):
+    return table_arg(table).ref(key_arg(key), default)
+
+def hash_set(table, key, value):
+    table_arg(table).set(key_arg(key), value)
+
+def hash_remove(table, key):
+    table_arg(table).remove(key_arg(key))
+
+def hash_keys(table):
+    return from_list(table_arg(table).table.keys() + [nil])
+
+def hash_for_each_func(args, env):
+    evaled_args = eval_list(args, env)
+    assert len(evaled_args) == 2, "hash-for-each needs a hash table and a procedure"
+    table, func = evaled_args
+    # a copy, so the procedure can change the table
+    for key, value in table_arg(table).table.items():
+        call_procedure(func, [key, value], env)
+    return nil
+
+# -----------------------------------------------------------------------------
+# profile
+#
+# (profile <expr>)
+#
+# Evaluate <expr> with the profiler running (see profiler.py) then print how
+# many times each procedure was called and how long it took, longest first.
+# Its result is that of <expr>.
+#
+# example:
+#   (profile (fib 15))
+#
+#        calls       self      total   per call  procedure
+#         1973   0.031519   0.058807   0.000030  fib
+#         3945   0.011604   0.011604   0.000003  +
+#   ...
+# -----------------------------------------------------------------------------
+
+def profile_func(args, env):
+    assert rest(args) is nil
+    return profile(lambda: evaluate(first(args), env), sys.stdout, builtin_names())
+
+# -----------------------------------------------------------------------------
+
+def display(value):
+    # written a piece at a time, so a huge value is never one big string
+    write(value, sys.stdout)
+    sys.stdout.write("\n")
 
 # -----------------------------------------------------------------------------
 
@@ -507,11 +963,24 @@ def make_basic_environment():
 
         ("import"     , import_func),
         ("include"    , include_func),
+        ("reload"     , reload_func),
+        ("save-image" , save_image_func),
+        ("load-image" , load_image_func),
+        ("import-stats", predefined_function(module_cache.stats)),
         ("env"        , env_func),
 
+        ("call/cc"                        , callcc_func),
+        ("call-with-current-continuation" , callcc_func),
+
         ("stack"   , predefined_function(get_stack)),
+        ("profile" , profile_func),
+
+        ("stats"          , counters.stats_func),
+        ("stats-reset!"   , counters.stats_reset_func),
+        ("stats-enable!"  , counters.stats_enable_func),
+        ("stats-disable!" , counters.stats_disable_func),
 
-        ("display", predefined_function(lambda a: display(str(a)))),
+        ("display", predefined_function(display)),
         ("newline", predefined_function(lambda a: display("\n"))),
 
         ("cons"   , predefined_function(cons)),
@@ -520,14 +989,39 @@ def make_basic_environment():
         ("is?"    , predefined_function(lambda x, y: to_scm_bool(x is y))),
         ("equal?" , predefined_function(lambda x, y: to_scm_bool(x == y))),
 
-        ("+",  two_integer_function(lambda a, b: a + b)),
-        ("*",  two_integer_function(lambda a, b: a * b)),
-        ("-",  two_integer_function(lambda a, b: a - b)),
-        ("<",  two_integer_function(lambda a, b:to_scm_bool(a < b))),
-        (">",  two_integer_function(lambda a, b:to_scm_bool(a > b))),
-        ("=",  two_integer_function(lambda a, b:to_scm_bool(a == b))),
-        ("<=", two_integer_function(lambda a, b:to_scm_bool(a <= b))),
-        (">=", two_integer_function(lambda a, b:to_scm_bool(a >= b)))]
+        ("apply"  , apply_func),
+
+        ("+",  arithmetic_function(operator.add, 0)),
+        ("*",  arithmetic_function(operator.mul, 1)),
+        ("-",  arithmetic_function(operator.sub, None, operator.neg)),
+        ("<",  comparison_function(operator.lt)),
+        (">",  comparison_function(operator.gt)),
+        ("=",  comparison_function(operator.eq)),
+        ("<=", comparison_function(operator.le)),
+        (">=", comparison_function(operator.ge)),
+
+        ("vector"        , predefined_function(lambda *nums: make_vector(map(integer_arg, nums)))),
+        ("make-vector"   , predefined_function(make_vector_func)),
+        ("list->vector"  , predefined_function(list_to_vector)),
+        ("vector->list"  , predefined_function(vector_to_list)),
+        ("vector-length" , predefined_function(lambda vec: make_integer(len(vector_arg(vec))))),
+        ("vector-ref"    , predefined_function(lambda vec, n: vector_arg(vec).ref(integer_arg(n)))),
+        ("vector-set!"   , predefined_function(vector_set)),
+        ("vector-sum"    , predefined_function(lambda vec: make_integer(vector_arg(vec).sum()))),
+        ("vector-dot"    , predefined_function(lambda a, b: make_integer(vector_arg(a).dot(vector_arg(b))))),
+        ("vector+"       , elementwise_function(operator.add)),
+        ("vector-"       , elementwise_function(operator.sub)),
+        ("vector*"       , elementwise_function(operator.mul)),
+        ("vector-map"    , vector_map_func),
+
+        ("make-hash-table" , predefined_function(LispHashTable)),
+        ("hash-ref"        , predefined_function(hash_ref)),
+        ("hash-set!"       , predefined_function(hash_set)),
+        ("hash-remove!"    , predefined_function(hash_remove)),
+        ("hash-count"      , predefined_function(lambda table: make_integer(len(table_arg(table))))),
+        ("hash-keys"       , predefined_function(hash_keys)),
+        ("hash->list"      , predefined_function(lambda table: table_arg(table).to_alist())),
+        ("hash-for-each"   , hash_for_each_func)]
 
     syms, vals = [], []
     for sym,val in basic:
@@ -538,6 +1032,56 @@ def make_basic_environment():
 
 basic_environment = make_basic_environment()
 
+# vector-map with one of these is done element-wise
+elementwise_operators = {
+    basic_environment.get("+") : operator.add,
+    basic_environment.get("-") : operator.sub,
+    basic_environment.get("*") : operator.mul}
+
+def builtin_names():
+    # builtin_names :: None -> {Int: Str}
+    # the name of each builtin value, by id
+    names = {id(basic_environment): "basic_environment"}
+    for name, variable in basic_environment.variables.items():
+        names[id(variable.value)] = name
+    return names
+
+# -----------------------------------------------------------------------------
+# Library
+#
+# The rest of the standard library is in the modules in lib/. None of them 
+# is loaded until one of its names is looked up and not found, then it is 
+# imported (see `module_cache`) and all of its names are defined in 
+# `basic_environment`. A script only pays for the modules it uses.
+# -----------------------------------------------------------------------------
+
+library_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lib")
+
+library = [
+    ("base.scm"  , ["list", "when", "unless", "assert-eq", "not", "null?", 
+                    "id", "flip"]),
+    ("fold.scm"  , ["foldr", "foldl", "unfold", "fold", "inject", "reduce", 
+                    "concat", "length"]),
+    ("let.scm"   , ["gather-args", "let"]),
+    ("class.scm" , ["class-set-many!", "new"])]
+
+def autoload_module(file_name, names):
+    # autoload_module :: Str -> [Str] -> None
+    path = os.path.join(library_path, file_name)
+
+    def load(env):
+        module = module_cache.import_module(path)
+        for name in names:
+            if name not in env.variables:
+                env.define(name, None, module.get(name))
+
+    for name in names:
+        basic_environment.autoloads[name] = load
+
+basic_environment.autoloads = {}
+for file_name, names in library:
+    autoload_module(file_name, names)
+
 # -----------------------------------------------------------------------------
 
 
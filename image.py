@@ -0,0 +1,78 @@
+import cPickle
+
+from datatypes import LispLambda, LispClass, Continuation, frame_names, invalidate_lookups
+
+# -----------------------------------------------------------------------------
+# Images
+#
+# (save-image <file-name>)
+# (load-image <file-name>)
+#
+# Save the current environment, and everything it refers to (its parents,
+# procedures, classes, data...), to a file with pickle. Loading the file
+# gives back the environment in one step, without evaluating anything, so a
+# process can start with i.e. the prelude already included.
+#
+# The builtins (anything in `basic_environment`, and it too) are python
+# functions which can't be pickled, they are saved by name and linked to
+# the ones in this process when loaded. Symbols are interned again when
+# they are loaded. Compiled procedures lose their compiled code and are
+# walked instead.
+#
+# A list is saved as a python list of its elements (see LispPair.__getstate__)
+# so it can be any length. Only its first pair keeps its identity, any pair
+# in the middle of it that is also referred to elsewhere loads as two.
+#
+# example:
+#   nil    <= (include "prelude.scm")
+#   nil    <= (save-image "prelude.image")
+#
+#   and then in another process
+#   env = load_image("prelude.image")
+# -----------------------------------------------------------------------------
+
+IMAGE_VERSION = 4
+
+def save_image(env, file_name):
+    # save_image :: Environment -> Str -> None
+    from function import builtin_names  # function imports this module
+    names = builtin_names()
+
+    def persistent_id(obj):
+        return names.get(id(obj))
+
+    with open(file_name, "wb") as stream:
+        pickler = cPickle.Pickler(stream, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump((IMAGE_VERSION,
+                      (LispLambda.lambda_id, LispClass.classid,
+                       Continuation.continuation_id),
+                      set(frame_names),
+                      env))
+
+def load_image(file_name):
+    # load_image :: Str -> Environment
+    from function import basic_environment  # function imports this module
+
+    def persistent_load(name):
+        if name == "basic_environment":
+            return basic_environment
+        # which may need to be autoloaded
+        return basic_environment.get(name)
+
+    with open(file_name, "rb") as stream:
+        unpickler = cPickle.Unpickler(stream)
+        unpickler.persistent_load = persistent_load
+        version, ids, names, env = unpickler.load()
+    assert version == IMAGE_VERSION, "image is version %s not %s" % (version, IMAGE_VERSION)
+
+    # new procedures and classes must not get the ids of the loaded ones
+    LispLambda.lambda_id = max(LispLambda.lambda_id, ids[0])
+    LispClass.classid = max(LispClass.classid, ids[1])
+    Continuation.continuation_id = max(Continuation.continuation_id, ids[2])
+
+    # names bound in the loaded frames can't be cached (see LookupSite)
+    frame_names.update(names)
+    invalidate_lookups()
+
+    return env
@@ -1,6 +1,6 @@
-
-import string 
+import string
 import re
+import mmap
 
 test_list = []
 
@@ -8,34 +8,162 @@ specialtokens = set("()'.")
 atoms = string.ascii_letters + string.digits + "-_<>%=!^&?*+/"
 normalchars = set(atoms)
 
+# -----------------------------------------------------------------------------
+# Tokens
+#
+# The source is walked once with `token_pattern`, each match is some spaces
+# followed by one of:
+#
+#   1 - the end of a line
+#   2 - a token, i.e. a bracket, quote, atom, string or comment
+#   3 - the start of a string that is not closed (yet)
+#   4 - anything else, which is an error
+#
+# Every character is matched by one of these so `finditer` never skips any
+# input. Tokens are yielded as they are found, as a `Token` (a str) which
+# remembers where in the source it started.
 # -----------------------------------------------------------------------------
 
+token_pattern = re.compile(
+    r'[ \t\r\f\v]*(?:'
+    r'(\n)|'
+    r'([()\'.`,]|[\w<>%=!^&?*+/-]+|"[^"]*"|;[^\n]*)|'
+    r'("[^"]*)|'
+    r'(.))')
+
+class Token(str):
+    """A token, it also has the `line` and `column` (from 1) it started on"""
+
+def make_token(text, line, column):
+    # make_token :: Str -> Int -> Int -> Token
+    token = Token(text)
+    token.line = line
+    token.column = column
+    return token
+
+class Scanner(object):
+    """Tokenizes a source one piece of text at a time, keeping count of the
+    lines. A string left open at the end of a piece is kept in `pending`
+    until a later piece closes it."""
+
+    def __init__(self):
+        self.line = 1
+        self.pending = None
+        self.pending_at = None
+
+    def scan(self, text, pos=0, line_start=0):
+        # scan :: Str -> Int -> Int -> Iterator Token
+        # tokenize `text` from `pos`, where `line_start` is the position
+        # that the current line starts at
+        line = self.line
+
+        for match in token_pattern.finditer(text, pos):
+            kind = match.lastindex
+            if kind == 1:
+                line += 1
+                line_start = match.end()
+
+            elif kind == 2:
+                start = match.start(2)
+                token = make_token(match.group(2), line, start - line_start + 1)
+                if token[0] == '"' and "\n" in token:
+                    line += token.count("\n")
+                    line_start = start + token.rindex("\n") + 1
+                yield token
+
+            elif kind == 3:
+                # it runs to the end of the text
+                start = match.start(3)
+                self.pending = [match.group(3)]
+                self.pending_at = (line, start - line_start + 1)
+
+            else:
+                assert False, "invalid input at line %d column %d: '%s'" % (
+                    line, match.start(4) - line_start + 1, match.group(4))
+
+        self.line = line
+
+    def close_string(self, text):
+        # close_string :: Str -> (Optional Token, Optional Int)
+        # if `text` ends the pending string returns the Token and the
+        # position after it, otherwise keeps it for later
+        end = text.find('"')
+        if end == -1:
+            self.pending.append(text)
+            return None, None
+
+        self.pending.append(text[:end + 1])
+        line, column = self.pending_at
+        token = make_token("".join(self.pending), line, column)
+        self.line = line + token.count("\n")
+        self.pending = None
+        return token, end + 1
+
+    def finish(self):
+        assert self.pending is None, "string not closed at line %d column %d" % self.pending_at
+
+def scan_text(text):
+    # scan_text :: Str | mmap -> Iterator Token
+    scanner = Scanner()
+    for token in scanner.scan(text):
+        yield token
+    scanner.finish()
+
+def scan_lines(lines):
+    # scan_lines :: Iterable Str -> Iterator Token
+    # each item is a line (or a few), only a string can run on to the next
+    scanner = Scanner()
+    for text in lines:
+        if not text.endswith("\n"):
+            text += "\n"
+
+        pos = 0
+        if scanner.pending is not None:
+            token, pos = scanner.close_string(text)
+            if token is None:
+                continue
+            yield token
+
+        line_start = text.rfind("\n", 0, pos) + 1
+        for token in scanner.scan(text, pos, line_start):
+            yield token
+    scanner.finish()
+
+def scan_file(stream):
+    # scan_file :: file -> Iterator Token
+    # a real file is memory mapped, so it is neither read into memory nor
+    # copied, anything else (a pipe, a terminal) is read line by line
+    try:
+        text = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        # empty files cannot be mapped either
+        for token in scan_lines(stream):
+            yield token
+        return
+
+    try:
+        for token in scan_text(text):
+            yield token
+    finally:
+        text.close()
 
+# -----------------------------------------------------------------------------
 
 def readtoken(text):
+    # readtoken :: Str -> (Str, Str)
+    # the first token of `text` and the rest of it (use `tokenize` to get
+    # all of them)
     text = text.strip()
 
     assert len(text) != 0, "invalid input: '" + text + "'"
 
-    if text[0] in specialtokens:
-        return text[0], text[1:]
+    result = token_pattern.match(text)
+    assert result.lastindex == 2, "invalid input: '" + text + "'"
 
-    pattern = re.compile("([()'.`,]|[\w<>%=!^&?*+/-]+|\"[^\"]*\"|;.*)")
-    result = pattern.match(text)
-    
-    assert result, "invalid input: '" + text + "'"
-
-    if result.end() == len(text):
-        return result.group(), ""
-
-    return result.group() , text[result.end():]
+    return result.group(2), text[result.end():]
 
 def readtokens(text):
-    res = []
-    while len(text) != 0:
-        tok, text = readtoken(text)
-        res.append(tok)
-    return res
+    return list(tokenize(text))
 
 def test_readtoken():
     print "testing: readtoken"
@@ -53,15 +181,16 @@ test_list.append(test_readtoken)
 
 # -----------------------------------------------------------------------------
 
-def tokenize(iterable):
-    if isinstance(iterable,str):
-        yield readtokens(iterable)
+def tokenize(source):
+    # tokenize :: Str | mmap | file | Iterable Str -> Iterator Token
+    # an iterable (i.e. a list or a file's lines) gives one or more lines
+    # at a time
+    if isinstance(source, (str, mmap.mmap)):
+        return scan_text(source)
+    elif isinstance(source, file):
+        return scan_file(source)
     else:
-        for text in iterable:
-            text = text.strip()
-            while len(text) != 0:
-                tok, text = readtoken(text)
-                yield tok
+        return scan_lines(source)
 
 def test_tokenize():
     print "testing: tokenize"
@@ -71,7 +200,7 @@ def test_tokenize():
     assert list(tokenize("""
 (
    'hi
-()  hope this 
+()  hope this
 
            ;cmt
 works
@@ -81,6 +210,27 @@ works
 
 """.splitlines())) == "( ' hi ( ) hope this ;cmt works ok )".split()
 
+    # the same as one string
+    tokens = list(tokenize("(a\n  'bb ;cmt\n c)"))
+    assert tokens == ["(", "a", "'", "bb", ";cmt", "c", ")"]
+    assert [(t.line, t.column) for t in tokens] == [
+        (1, 1), (1, 2), (2, 3), (2, 4), (2, 7), (3, 2), (3, 3)]
+
+    # strings can have new lines in them, when given as lines or not
+    for source in [['(a "x', '', 'y" b)'], '(a "x\n\ny" b)']:
+        tokens = list(tokenize(source))
+        assert tokens == ["(", "a", '"x\n\ny"', "b", ")"]
+        assert [(t.line, t.column) for t in tokens] == [
+            (1, 1), (1, 2), (1, 4), (3, 4), (3, 5)]
+
+    for source in ['(a "b)', ['(a "b)', ''], "(a #)"]:
+        try:
+            list(tokenize(source))
+        except AssertionError:
+            pass
+        else:
+            assert False, "invalid input accepted: %r" % source
+
 test_list.append(test_tokenize)
 
 
@@ -0,0 +1,17 @@
+;; The most common definitions, see the `library` in function.py for what
+;; each module defines.
+
+(define (list . x) x)
+
+(define when   (mac (<cond>.<body>) (list 'if <cond> (cons 'begin <body>))))
+(define unless (mac (<cond>.<body>) (list 'if <cond> nil
+                                          (cons 'begin <body>))))
+
+(define (assert-eq a b)
+  (unless (equal? a b)
+          (display (list "ERROR: assert-eq" a b))))
+
+(define (not x) (if x false true))
+(define (null? obj) (is? obj nil))
+(define (id x) x)
+(define (flip f) (lambda(x y) (f y x)))
@@ -0,0 +1,13 @@
+;; Making instances of classes.
+
+;; (class-set-many! p1 '(x 1 y 2))
+(define (class-set-many! name things)
+  (unless (is things nil)
+      (class-set! name (car things) (car (cdr things)))
+      (class-set-many! name (cdr (cdr things)))))
+
+;; (new p1 point x 1 y 2)
+(define new (mac (<name> <parent> . <data>)
+                 `(begin
+                    (define ,<name> (class ,<parent>))
+                    (class-set-many! ,<name> ',<data>))))
@@ -0,0 +1,37 @@
+;; Folds and the things made from them.
+
+(define (foldr f x xs)
+  (if (null? xs)
+    x
+    (f
+      (car xs)
+      (foldr f x (cdr xs)))))
+
+(define (foldl f x xs)
+  (if (null? xs)
+    x
+    (foldl
+      f
+      (f x (car xs))
+      (cdr xs))))
+
+(define (unfold func init pred)
+  (if (pred init)
+      (cons init '())
+      (cons init (unfold func (func init) pred))))
+
+
+(define fold foldl)
+(define (inject x f xs)  (foldl f x xs))
+(define (reduce f xs)    (foldl f (car xs) (cdr xs)))
+
+
+(define concat
+  (lambda(x y)
+    (foldr
+     (lambda(a b)(cons a b))
+     y
+     x)))
+
+(define (length lst)
+  (foldr (lambda (a b) (+ 1 b)) 0 lst))
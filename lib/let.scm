@@ -0,0 +1,22 @@
+;; let, made from lambda.
+
+(define (gather-args args)
+  ;; take argument in the form (a1 v1) (a2 v2) ...
+  ;; change them to the form (a1 a2 ...) (v1 v2 ...)
+  (foldr
+   (lambda (x xs)
+     (cons
+      (cons (car x) (car xs))   ; first part is the a's
+      (cons (car (cdr x)) (cdr xs)))) ; first part is the v's
+   '(nil . nil)
+   args))
+
+;; (let ((x 2) (y 3))(* x y)) --> ((lambda (x y) (* x y)) 2 3)
+(define let (mac (<bindings> <body>)
+                 ;; (let ((a1 v1) (a2 v2) ... ) b1 ...)
+                 ;; ((lambda (a1 a2 ...) b1 ...)) v1 v2 ...)
+                 ;; (car (gather-args <bindings>)) ;; a's
+                 ;; (cdr (gather-args <bindings>)) ;; v's
+                 (cons (list 'lambda (car (gather-args <bindings>))
+                       <body>)
+                       (cdr (gather-args <bindings>)))))
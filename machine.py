@@ -0,0 +1,301 @@
+from datatypes import nil, true, to_list, first, rest, LispSymbol, LispPair, LispLambda, Continuation, ContinuationInvoked, trampoline, call_stack
+
+import function
+from function import quote_func, set_func, define_func, if_func, lambda_func, begin_func, macro_func, callcc_func
+
+# -----------------------------------------------------------------------------
+# MACHINE
+#
+# A register machine evaluator. The tree walker and the compiler use the
+# python stack to remember what to do once a sub-expression has a value, so
+# non-tail recursion (`foldr`, `length` in prelude.scm) is limited by the
+# python recursion limit. Here that is kept on the heap as an explicit stack
+# of continuation frames; recursion is only limited by memory.
+#
+# The machine has three registers, `expr` and `env` (what to evaluate next)
+# and `val` (the last value). Each step either evaluates `expr` or pops the
+# top continuation frame and gives it `val`. The frames are tuples:
+#
+#   (OPERATOR, sexp, env)                 - val is the operator of sexp
+#   (ARGUMENT, proc, args, done, env)     - val is the first of args, done
+#                                           the list of values before it
+#   (RETURN,)                             - val is the result of a call
+#   (MACRO, proc, args, env)              - val is an expansion to evaluate
+#   (IF, args, env)                       - val is the predicate
+#   (BEGIN, sexps, n, env)                - val can be ignored
+#   (DEFINE, name, env)                   - val is the value to define
+#   (SET, name, env)                      - val is the value to set
+#
+# The frames are never changed, apart from the `done` list of an ARGUMENT 
+# frame which each argument's value is added to (rather than making a new
+# tuple of them each time, which would make a call O(n^2) in its arguments).
+# So a copy of the stack with those lists copied too (see `copy_frames`) is a
+# complete continuation, `call/cc` can be resumed any number of times and at
+# any point later, even from another top level form.
+#
+# A RETURN frame is pushed for each call, and the called procedure is put on
+# `call_stack` until it is popped, so `(stack)` works as it does in the tree
+# walker. A call made when the top of the stack is already a RETURN frame is
+# in tail position and replaces it rather than adding another.
+#
+# Special forms other than those listed in `syntax` (i.e. classes, include,
+# quasiquote) are called with the raw arguments as usual and so evaluate
+# their arguments with the python stack. A continuation captured inside them
+# can only be used to escape.
+# -----------------------------------------------------------------------------
+
+OPERATOR, ARGUMENT, RETURN, MACRO, IF, BEGIN, DEFINE, SET = range(8)
+
+syntax = {
+    quote_func  : "quote",
+    lambda_func : "lambda",
+    macro_func  : "mac",
+    if_func     : "if",
+    begin_func  : "begin",
+    define_func : "define",
+    set_func    : "set!"}
+
+def execute(expr, env):
+    # execute :: LispBase -> Environment -> LispBase
+
+    stack = []
+    base = len(call_stack)
+    val = None
+    evaluating = True
+
+    try:
+        while True:
+
+            # -------------------------------------------------- evaluate expr
+            if evaluating:
+                if isinstance(expr, LispPair):
+                    stack.append((OPERATOR, expr, env))
+                    if isinstance(expr.first, LispPair):
+                        expr = expr.first
+                        continue
+                    # an atom can be done here (with the pair's LookupSite)
+                    val = expr.eval_first(env)
+                elif isinstance(expr, LispSymbol):
+                    val = env.get(expr.name)
+                else:
+                    val = expr.scm_eval(env)
+                evaluating = False
+
+            # -------------------------------------------------- return val
+            if not stack:
+                return val
+
+            frame = stack.pop()
+            kind = frame[0]
+
+            if kind is RETURN:
+                call_stack.pop()
+
+            elif kind is ARGUMENT:
+                _, func, args, done, env = frame
+                done.append(val)
+                # evaluate each atom here, only pairs need the stack
+                args = args.rest
+                while isinstance(args, LispPair) and not isinstance(args.first, LispPair):
+                    done.append(args.eval_first(env))
+                    args = args.rest
+
+                if isinstance(args, LispPair):
+                    stack.append((ARGUMENT, func, args, done, env))
+                    expr = args.first
+                    evaluating = True
+                else:
+                    assert args is nil, "invalid application: %s" % args
+                    expr, env, val, evaluating = apply_procedure(func, done, env, stack, base)
+
+            elif kind is OPERATOR:
+                _, sexp, env = frame
+                func = val
+                args = sexp.rest
+                form = syntax.get(func) if callable(func) else None
+
+                if form is not None:
+                    expr, env, val, evaluating = special_form(form, func, args, env, stack)
+
+                elif isinstance(func, LispLambda) and func.macro:
+                    expr = func.cached_expansion(args)
+                    if expr is None:
+                        # expand in a new env, eval the expansion in this one
+                        # (see LispLambda.expand, it is kept for next time)
+                        call_stack.append(func)
+                        stack.append((RETURN,))
+                        stack.append((MACRO, func, args, env))
+                        expr = func.body
+                        list_args = to_list(args)
+                        assert list_args[-1] is nil, "invalid macro call: %s" % sexp
+                        env = func.bind(list_args[:-1], env)
+                    evaluating = True
+
+                elif (isinstance(func, (LispLambda, Continuation)) or
+                      func is callcc_func or
+                      getattr(func, "primitive", None) is not None):
+                    # procedures have their arguments evaluated on the stack
+                    call_stack.append(func)
+                    stack.append((RETURN,))
+                    done = []
+                    while isinstance(args, LispPair) and not isinstance(args.first, LispPair):
+                        done.append(args.eval_first(env))
+                        args = args.rest
+
+                    if isinstance(args, LispPair):
+                        stack.append((ARGUMENT, func, args, done, env))
+                        expr = args.first
+                        evaluating = True
+                    else:
+                        assert args is nil, "invalid application: %s" % sexp
+                        expr, env, val, evaluating = apply_procedure(func, done, env, stack, base)
+
+                else:
+                    # a special form that looks after itself
+                    assert callable(func), "cannot call '%s' in %s" % (func, sexp)
+                    call_stack.append(func)
+                    try:
+                        val = trampoline(func(args, env))
+                        call_stack.pop()
+                    except ContinuationInvoked, invoked:
+                        val = resume(invoked.continuation, invoked.value, stack, base)
+
+            elif kind is IF:
+                _, args, env = frame
+                if val is true:
+                    expr = args[1]
+                else:
+                    expr = args[2]
+                evaluating = True
+
+            elif kind is BEGIN:
+                _, sexps, n, env = frame
+                if n + 1 < len(sexps) - 1:
+                    stack.append((BEGIN, sexps, n + 1, env))
+                expr = sexps[n]
+                evaluating = True
+
+            elif kind is MACRO:
+                _, func, args, env = frame
+                func.cache_expansion(args, val)
+                expr = val
+                evaluating = True
+
+            elif kind is DEFINE:
+                _, name, env = frame
+                # todo set the datatype
+                env.define(name, None, val)
+                val = nil
+
+            elif kind is SET:
+                _, name, env = frame
+                env.set(name, val)
+                val = nil
+
+            else:
+                raise Exception("unknown frame: %s" % (frame,))
+
+    finally:
+        del call_stack[base:]
+
+def special_form(form, func, args, env, stack):
+    # special_form :: Str -> Func -> LispPair -> Environment -> Stack ->
+    #                   (LispBase, Environment, LispBase, Bool)
+    # returns the new registers (expr, env, val, evaluating)
+
+    if form == "if":
+        list_args = to_list(args)
+        assert list_args[-1] is nil
+        assert 3 <= len(list_args) <= 4
+        stack.append((IF, list_args, env))
+        return list_args[0], env, None, True
+
+    elif form == "begin":
+        sexps = to_list(args)
+        assert sexps[-1] is nil, "invalid args for 'begin': %s" % sexps
+        assert len(sexps) >= 2, "invalid args for 'begin': %s" % sexps
+        if len(sexps) > 2:
+            stack.append((BEGIN, sexps, 1, env))
+        return sexps[0], env, None, True
+
+    elif form == "define" and isinstance(first(args), LispSymbol):
+        list_args = to_list(args)
+        assert list_args[-1] is nil
+        assert len(list_args) == 3
+        stack.append((DEFINE, list_args[0].name, env))
+        return list_args[1], env, None, True
+
+    elif form == "set!":
+        list_args = to_list(args)
+        assert list_args[-1] is nil
+        assert len(list_args) == 3
+        assert isinstance(list_args[0], LispSymbol)
+        stack.append((SET, list_args[0].name, env))
+        return list_args[1], env, None, True
+
+    else:
+        # quote, lambda, mac and (define (f . args) ...) never need to
+        # evaluate anything
+        return None, env, func(args, env), False
+
+def apply_procedure(func, done, env, stack, base):
+    # apply_procedure :: LispBase -> [LispBase] -> Environment -> Stack ->
+    #                      Int -> (LispBase, Environment, LispBase, Bool)
+    # the top of the stack is the RETURN frame for this call, `done` is no
+    # longer in any frame so the call can have it
+
+    while True:
+        if isinstance(func, LispLambda):
+            if len(stack) >= 2 and stack[-2][0] is RETURN:
+                # tail call: take over the caller's RETURN frame
+                stack.pop()
+                call_stack.pop()
+                call_stack[-1] = func
+            new_env = func.bind(done, env)
+            return func.body, new_env, None, True
+
+        elif isinstance(func, Continuation):
+            assert len(done) == 1, "a continuation takes one value"
+            return None, env, resume(func, done[0], stack, base), False
+
+        elif func is callcc_func:
+            assert len(done) == 1, "call/cc takes one procedure"
+            # the continuation is everything below this call
+            stack.pop()
+            call_stack.pop()
+            continuation = Continuation(copy_frames(stack), call_stack[base:])
+
+            # then call the procedure in its place
+            func, done = done[0], [continuation]
+            call_stack.append(func)
+            stack.append((RETURN,))
+
+        else:
+            return None, env, func.primitive(*done), False
+
+def copy_frames(stack):
+    # copy_frames :: Stack -> Stack
+    # a copy of the stack that shares no `done` list with it, so neither is
+    # changed by evaluating the other
+    copy = []
+    for frame in stack:
+        if frame[0] is ARGUMENT:
+            _, func, args, done, env = frame
+            frame = (ARGUMENT, func, args, list(done), env)
+        copy.append(frame)
+    return copy
+
+def resume(continuation, value, stack, base):
+    # resume :: Continuation -> LispBase -> Stack -> Int -> LispBase
+    # replace the current continuation, returns the value to give it
+
+    if continuation.stack is None:
+        # not one of ours, let the call/cc that made it catch it
+        raise ContinuationInvoked(continuation, value)
+
+    stack[:] = copy_frames(continuation.stack)
+    del call_stack[base:]
+    call_stack.extend(continuation.calls)
+    return value
+
+function.evaluators["machine"] = execute
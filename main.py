@@ -1,8 +1,22 @@
 
+import os
+import sys
+import shutil
+import tempfile
+import cStringIO
+
 from lex import tokenize
-from parse import parse
-from function import basic_environment, read_file
-from datatypes import Environment
+from parse import parse, test as test_parse
+from function import basic_environment, read_file, evaluate, set_evaluator, module_cache, library, builtin_names
+from printer import write, test as test_printer
+from datatypes import Environment, InvalidPermission, AlreadyDefined, to_list, mksym
+import datatypes
+import formcache
+import compiler
+import machine
+from image import load_image
+import counters
+from profiler import Profiler, Sampler, procedure_name
 
 DEBUG = False
 
@@ -14,10 +28,20 @@ def repl(env, parser):
 
     for sexp in parser:
         # if DEBUG: print "#< ", str(sexp)
-        result = sexp.scm_eval(env)
+        result = evaluate(sexp, env)
         # if DEBUG: print "#> ", str(result)
         yield str(result)
 
+def print_repl(env, parser, port=sys.stdout, prompt="", depth=None, length=None):
+    """as `repl` but writes each result to `port` as it goes (see 
+       printer.write), rather than making it into a string"""
+
+    for sexp in parser:
+        result = evaluate(sexp, env)
+        port.write(prompt)
+        write(result, port, depth, length)
+        port.write("\n")
+
 
 # -----------------------------------------------------------------------------
 
@@ -47,7 +71,7 @@ def reader_raw():
 
 # -----------------------------------------------------------------------------
 
-def testall():
+def testall(evaluator="tree"):
     to_test = [
         # -------------------------------------- Special Symbols
         ("nil"   , "()" ),
@@ -118,6 +142,62 @@ def testall():
         ("false"        , "(= 5 4)"),
         ("false"        , "(= 4 5)"),
         ("true"         , "(= 5 5)"),
+        ("0"            , "(+)"),
+        ("1"            , "(*)"),
+        ("7"            , "(+ 7)"),
+        ("-7"           , "(- 7)"),
+        ("10"           , "(+ 1 2 3 4)"),
+        ("24"           , "(* 1 2 3 4)"),
+        ("4"            , "(- 10 1 2 3)"),
+        ("true"         , "(< 1 2 3)"),
+        ("false"        , "(< 1 3 2)"),
+        ("true"         , "(<= 1 1 2)"),
+        ("true"         , "(= 5)"),
+        ("false"        , "(= 5 5 4)"),
+        ("true"         , "(>= 3 2 2 1)"),
+        ("10"           , "(apply + '(1 2 3 4))"),
+        ("10"           , "(apply + 1 2 '(3 4))"),
+        ("0"            , "(apply + '())"),
+        ("5"            , "(apply (lambda (x y) (+ x y)) '(2 3))"),
+        ("true"         , "(apply < (cons 1 (cons 2 nil)))"),
+        # -------------------------------------- Vectors
+        ("#( 1 2 3 )"   , "(vector 1 2 3)"),
+        ("#( 7 7 )"     , "(make-vector 2 7)"),
+        ("nil"          , "(define vec (list->vector '(1 2 3)))"),
+        ("( 1 2 3 )"    , "(vector->list vec)"),
+        ("3"            , "(vector-length vec)"),
+        ("nil"          , "(vector-set! vec 0 10)"),
+        ("10"           , "(vector-ref vec 0)"),
+        ("15"           , "(vector-sum vec)"),
+        ("113"          , "(vector-dot vec vec)"),
+        ("#( 20 4 6 )"  , "(vector+ vec vec)"),
+        ("#( 9 1 2 )"   , "(vector- vec 1)"),
+        ("#( 20 4 6 )"  , "(vector* vec 2)"),
+        ("#( 100 4 9 )" , "(vector-map * vec vec)"),
+        ("#( 11 3 4 )"  , "(vector-map (lambda (x) (+ x 1)) vec)"),
+        ("true"         , "(equal? (vector 1 2) (vector 1 2))"),
+        ("false"        , "(equal? (vector 1 2) (vector 1 3))"),
+        ("0"            , "(vector-sum (vector))"),
+        # -------------------------------------- Hash Tables
+        ("nil"          , "(define tab (make-hash-table))"),
+        ("nil"          , "(hash-set! tab 'a 1)"),
+        ("nil"          , "(hash-set! tab \"b\" 2)"),
+        ("nil"          , "(hash-set! tab '(1 (2)) 3)"),
+        ("nil"          , "(hash-set! tab 70000 4)"),
+        ("1"            , "(hash-ref tab 'a)"),
+        ("2"            , "(hash-ref tab \"b\")"),
+        ("3"            , "(hash-ref tab (cons 1 (cons (cons 2 nil) nil)))"),
+        ("4"            , "(hash-ref tab (+ 69999 1))"),
+        ("0"            , "(hash-ref tab 'c 0)"),
+        ("4"            , "(hash-count tab)"),
+        ("nil"          , "(hash-remove! tab 'a)"),
+        ("3"            , "(hash-count tab)"),
+        ("false"        , "(hash-ref tab 'a false)"),
+        ("nil"          , "(define total 0)"),
+        ("nil"          , "(hash-for-each tab (lambda (k v) (set! total (+ total v))))"),
+        ("9"            , "total"),
+        ("true"         , "(equal? '(1 (2 \"x\")) '(1 (2 \"x\")))"),
+        ("false"        , "(equal? '(1 (2 \"x\")) '(1 (2 \"y\")))"),
         # -------------------------------------- Recurse (works but spams)
         ("nil"         , "(define (xxx x) (display 'in) (if (< x 10) (xxx (+ x 1))))"),
         # ("nil"         , "(xxx 0)"),
@@ -141,6 +221,18 @@ def testall():
                                 (+ w (+ y z)))
                               (inner x 1))"""),
         ("111"         ,"(outer 10 100)"),
+        # -------------------------------------- Closures
+        ("nil"         , "(define (make-adder n) (lambda (x) (+ x n)))"),
+        ("7"           , "((make-adder 3) 4)"),
+        ("nil"   , """(define (make-counter)
+                              (define count 0)
+                              (lambda () (set! count (+ count 1)) count))"""),
+        ("nil"         , "(define tick (make-counter))"),
+        ("1"           , "(tick)"),
+        ("2"           , "(tick)"),
+        ("nil"         , "(define scope 'lexical)"),
+        ("nil"         , "(define (get-scope) scope)"),
+        ("lexical"     , "((lambda (scope) (get-scope)) 'dynamic)"),
         # -------------------------------------- Fibonacci James
         ("nil"   , """(define (fibonacci-james n)
                                 (define (fib n1 n2 aaaaaa)
@@ -215,6 +307,30 @@ def testall():
         ("6"                 , "(p1 _y)"),
         ("10"                , "(p1 total)"),
         ("110"               , "(p1 thing 100)"),
+        # -------------------------------------- Class (inheritance)
+        ("nil"               , "(class-set! p1 'length 5)"),
+        ("5"                 , "(p1 length)"),
+        ("2"                 , "(Point length)"),
+        ("nil"               , "(define p2 (class Point))"),
+        ("nil"               , "(class-set! Point 'length 3)"),
+        ("3"                 , "(p2 length)"),
+        ("5"                 , "(p1 length)"),
+        ("nil"               , "(define A (class BaseClass))"),
+        ("nil"               , "(class-define! A 'who)"),
+        ("nil"               , "(class-set! A 'who 'a)"),
+        ("nil"               , "(define B (class A))"),
+        ("a"                 , "(B who)"),
+        ("nil"               , "(class-set! B 'who 'b)"),
+        ("a"                 , "(A who)"),
+        ("nil"               , "(define C (class B A))"),
+        ("b"                 , "(C who)"),
+        ("nil"               , "(define D (class A B))"),
+        ("b"                 , "(D who)"),
+        ("10"                , "(p1 total)"),
+        ("nil"               , "(class-set! Point 'total (lambda () (* (self _x) (self _y))))"),
+        ("24"                , "(p1 total)"),
+        ("nil"               , "(class-set! p1 'total (lambda () 7))"),
+        ("7"                 , "(p1 total)"),
         # -------------------------------------- Macros
         ("<#procedure#>" , "(mac (yyx) (+ 3 yyx))" ),
         ("3"             , "((mac (x) x) (+ 1 2))" ),
@@ -223,6 +339,12 @@ def testall():
         ("nil"           , "(define when (mac (test . body) (list 'if test (cons 'begin body))))" ),
         ("jam"           , "(when (= 4 4) 'jam)" ),
         ("nil"           , "(when (= 3 4) 'jam)" ),
+        ("nil"           , "(define pick (mac (a b) a))" ),
+        ("nil"           , "(define (use-pick) (pick 'x 'y))" ),
+        ("x"             , "(use-pick)" ),
+        ("x"             , "(use-pick)" ),
+        ("nil"           , "(set! pick (mac (a b) b))" ),
+        ("y"             , "(use-pick)" ),
         # -------------------------------------- Quasiquote
         ("a"                 , "(quasiquote a)" ),
         ("( a )"             , "(quasiquote (a))" ),
@@ -254,12 +376,17 @@ def testall():
         ("( list 3 4 )"      , "`(list ,(+ 1 2) 4)" ),
         ("( a b 3 4 )"       , "`(a . (b ,(+ 1 2) 4))" ),
         ("( a ( quasiquote ( b ( unquote c ) d ) ) e )" , "`(a`(b,c d)e)" ),
+        # -------------------------------------- Call/cc (escaping)
+        ("3"           , "(+ 1 (call/cc (lambda (k) 2)))"),
+        ("42"          , "(call/cc (lambda (k) (+ 1 (k 42))))"),
+        ("6"           , "(+ 1 (call/cc (lambda (k) (begin (k 5) 99))))"),
         # -------------------------------------- Done
         ("nil"         , "()" )]
 
     env = Environment([], [], basic_environment)
 
-    print "testing: toplevel"
+    print "testing: toplevel (%s)" % evaluator
+    set_evaluator(evaluator)
     for n, (expected, inp) in enumerate(to_test):
         if DEBUG: print "----"
         if DEBUG: print "input    ", inp
@@ -282,9 +409,231 @@ def testall():
             # print "  > sexp     ", exp
             print "  > result   ", res   
             print "-------------"
-            
-testall()
 
+    set_evaluator("tree")
+
+# -----------------------------------------------------------------------------
+
+def test_tail_calls(iterations=1000000):
+    """a tail recursive loop (through lambda, begin and if) must run in 
+       constant python stack and without keeping every frame alive"""
+
+    loop = """
+(define (loop n acc)
+  (begin
+    (if (= n 0)
+      (env)
+      (loop (- n 1) (+ acc 1)))))"""
+
+    for evaluator in ["tree", "compile", "machine"]:
+        print "testing: tail calls (%s)" % evaluator
+        set_evaluator(evaluator)
+
+        env = Environment([], [], basic_environment)
+        list(repl(env, parse(tokenize([loop]))))
+        code = "(loop %d 0)" % iterations
+        frame = evaluate(list(parse(tokenize([code])))[0], env)
+
+        assert frame.get("acc").num == iterations
+
+        # only the last frame should still be alive
+        depth = 0
+        while frame is not None:
+            depth += 1
+            frame = frame.parent()
+        assert depth == 3, "dead frames kept alive: %d" % depth
+
+    set_evaluator("tree")
+
+# -----------------------------------------------------------------------------
+
+def test_dynamic_scope():
+    """with `dynamic_scope` set a procedure sees the variables of its caller"""
+
+    to_test = [
+        ("nil"     , "(define scope 'lexical)"),
+        ("nil"     , "(define (get-scope) scope)"),
+        ("dynamic" , "((lambda (scope) (get-scope)) 'dynamic)"),
+        ("nil"     , "(define (make-adder n) (lambda (x) (+ x n)))"),
+        ("7"       , "((lambda (n) ((make-adder 100) 4)) 3)")]
+
+    datatypes.dynamic_scope = True
+    try:
+        for evaluator in ["tree", "compile", "machine"]:
+            print "testing: dynamic scope (%s)" % evaluator
+            set_evaluator(evaluator)
+            env = Environment([], [], basic_environment)
+            for expected, inp in to_test:
+                results = list(repl(env, parse(tokenize([inp]))))
+                assert results == [expected], "%s gave %s not %s" % (inp, results, expected)
+    finally:
+        datatypes.dynamic_scope = False
+        set_evaluator("tree")
+
+# -----------------------------------------------------------------------------
+
+def test_machine(size=100000):
+    """non-tail recursion in the machine is only limited by memory and its
+       continuations can be resumed after call/cc has returned"""
+
+    print "testing: machine"
+    set_evaluator("machine")
+
+    to_test = [
+        ("nil"   , """(define (foldr f x xs)
+                        (if (is? xs nil)
+                          x
+                          (f (car xs) (foldr f x (cdr xs)))))"""),
+        ("nil"   , "(define (length lst) (foldr (lambda (a b) (+ 1 b)) 0 lst))"),
+        ("nil"   , """(define (range n acc)
+                        (if (= n 0) acc (range (- n 1) (cons n acc))))"""),
+        ("nil"   , "(define big-list (range %d nil))" % size),
+        (str(size), "(length big-list)"),
+        # -------------------------------------- Re-entrant continuation
+        ("nil"   , "(define saved nil)"),
+        ("101"   , "(+ 100 (call/cc (lambda (k) (set! saved k) 1)))"),
+        ("105"   , "(saved 5)"),
+        ("110"   , "(begin (define x 4) (saved 10))"),
+        ("1101"  , "(+ 100 (call/cc (lambda (k) (set! saved k) 1)) 1000)"),
+        ("1105"  , "(saved 5)"),
+        ("1110"  , "(+ 1 (saved 10) 2)"),
+        # -------------------------------------- Inspect the stack
+        ("nil"   , "(define (inner) (stack))"),
+        ("nil"   , "(define (outer) (car (cons (inner) 1)))"),
+        ("nil"   , "(define trace (outer))"),
+        ("true"  , "(is? (car trace) outer)"),
+        ("true"  , "(is? (car (cdr (cdr (cdr trace)))) inner)")]
+
+    env = Environment([], [], basic_environment)
+    for expected, inp in to_test:
+        results = list(repl(env, parse(tokenize([inp]))))
+        assert results == [expected], "%s gave %s not %s" % (inp, results, expected)
+
+    set_evaluator("tree")
+
+# -----------------------------------------------------------------------------
+
+def test_modules():
+    """a file is only read once, until it changes or is reloaded"""
+
+    print "testing: modules"
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "module.scm")
+
+    def write_module(text):
+        with open(path, "w") as stream:
+            stream.write(text)
+
+    to_test = [
+        (None    , "(define loaded 1)"),
+        ("nil"   , '(define a (import "%s"))'),
+        ("true"  , '(is? a (import "%s"))'),
+        ("1"     , "(a loaded)"),
+        ("( ( hits . 1 ) ( loads . 1 ) ( reloads . 0 ) )", "(import-stats)"),
+        # -------------------------------------- Changed
+        (None    , "(define loaded 22)"),
+        ("false" , '(is? a (import "%s"))'),
+        ("22"    , '((import "%s") loaded)'),
+        ("false" , '(is? (import "%s") (reload "%s"))'),
+        ("( ( hits . 3 ) ( loads . 3 ) ( reloads . 1 ) )", "(import-stats)"),
+        # -------------------------------------- Include
+        ("22"    , '((lambda () (include "%s") loaded))'),
+        ("22"    , '((lambda () (include "%s") loaded))'),
+        ("( ( hits . 5 ) ( loads . 3 ) ( reloads . 1 ) )", "(import-stats)")]
+
+    module_cache.clear_stats()
+    hits, misses = formcache.hits, formcache.misses
+    env = Environment([], [], basic_environment)
+    try:
+        for expected, inp in to_test:
+            if expected is None:
+                write_module(inp)
+                continue
+            inp = inp.replace("%s", path)
+            results = list(repl(env, parse(tokenize([inp]))))
+            assert results == [expected], "%s gave %s not %s" % (inp, results, expected)
+
+        # each version of the file was parsed once, the reload used the 
+        # forms cached on disk
+        assert formcache.misses - misses == 2
+        assert formcache.hits - hits == 1
+        assert os.path.exists(path + formcache.extension)
+    finally:
+        shutil.rmtree(directory)
+
+# -----------------------------------------------------------------------------
+
+def test_image():
+    """an environment saved with save-image loads as it was"""
+
+    print "testing: image"
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "test.image")
+
+    setup = [
+        "(define data '(a (b . 2) \"c\"))",
+        "(define (make-counter) (define count 0) (lambda () (set! count (+ count 1)) count))",
+        "(define tick (make-counter))",
+        "(tick)",
+        "(define Point (class BaseClass))",
+        "(class-define! Point 'x)",
+        "(class-define! Point 'double)",
+        "(class-set! Point 'x 21)",
+        "(class-set! Point 'double (lambda () (* 2 (self x))))",
+        "(class-chmod! Point 'x 'read-only)",
+        '(save-image "%s")' % path]
+
+    to_test = [
+        ("( a ( b . 2 ) \"c\" )" , "data"),
+        ("true"                  , "(is? (car data) 'a)"),
+        ("2"                     , "(tick)"),
+        ("3"                     , "(tick)"),
+        ("42"                    , "(Point double)"),
+        ("true"                  , "(is? car (car (cons car nil)))"),
+        ("false"                 , "(is? tick (lambda () 1))")]
+
+    try:
+        env = Environment([], [], basic_environment)
+        list(repl(env, parse(tokenize(setup))))
+
+        loaded = load_image(path)
+        assert loaded is not env and loaded.parent() is basic_environment
+        for expected, inp in to_test:
+            results = list(repl(loaded, parse(tokenize([inp]))))
+            assert results == [expected], "%s gave %s not %s" % (inp, results, expected)
+
+        # permissions are kept
+        try:
+            list(repl(loaded, parse(tokenize(["(class-set! Point 'x 1)"]))))
+        except InvalidPermission:
+            pass
+        else:
+            assert False, "read-only variable was set"
+    finally:
+        shutil.rmtree(directory)
+
+def test_image_size(size=100000):
+    """a long list can be saved in an image"""
+
+    print "testing: image size"
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "test.image")
+
+    setup = [
+        "(define big '(%s . end))" % " ".join(map(str, xrange(size))),
+        '(save-image "%s")' % path]
+
+    try:
+        env = Environment([], [], basic_environment)
+        list(repl(env, parse(tokenize(setup))))
+
+        loaded = load_image(path)
+        items = to_list(loaded.get("big"))
+        assert len(items) == size + 1 and items[-1] is mksym("end")
+        assert [item.num for item in items[:-1]] == range(size)
+        assert list(repl(loaded, parse(tokenize(["(car (cdr (cdr big)))"])))) == ["2"]
+    finally:
+        shutil.rmtree(directory)
 
 # -----------------------------------------------------------------------------
 
@@ -303,13 +652,307 @@ prelude
     env = Environment([], [], basic_environment)
 
     if True:
-        for result in repl(env,parse(tokenize([inp]))):
-            print "$", result
+        print_repl(env, parse(tokenize([inp])), sys.stdout, "$ ")
 
     if False:
-        for result in repl(env,parse(tokenize(reader_raw()))):
-            print result
-main()
+        print_repl(env, parse(tokenize(reader_raw())), sys.stdout)
+
+# -----------------------------------------------------------------------------
+
+def test_permissions():
+    """each variable can only be used as its permission allows, and 
+       variables with the same permission share it"""
+
+    print "testing: permissions"
+    env = Environment([], [], basic_environment)
+    for inp in ["(define Q (class BaseClass))",
+                "(class-define! Q 'a)", "(class-define! Q 'b)",
+                "(class-define! Q 'c)", "(class-define! Q 'get-b)",
+                "(class-define! Q 'both)",
+                "(class-set! Q 'a 1)", "(class-set! Q 'b 2)", "(class-set! Q 'c 3)",
+                "(class-set! Q 'get-b (lambda () (self b)))",
+                "(class-set! Q 'both (lambda () (+ (self get-b) (self b))))",
+                "(class-chmod! Q 'a 'read-only)",
+                "(class-chmod! Q 'b 'private)",
+                "(class-chmod! Q 'c 'virtual)",
+                "(define q (class Q))"]:
+        list(repl(env, parse(tokenize([inp]))))
+
+    to_test = [
+        ("1"    , "(Q a)"),
+        (None   , "(class-set! Q 'a 5)"),
+        (None   , "(Q b)"),
+        ("2"    , "(Q get-b)"),
+        ("4"    , "(Q both)"),
+        (None   , "(Q c)"),
+        ("3"    , "(q c)"),
+        ("nil"  , "(class-set! q 'c 4)"),
+        ("4"    , "(q c)")]
+
+    for expected, inp in to_test:
+        try:
+            results = list(repl(env, parse(tokenize([inp]))))
+        except InvalidPermission:
+            results = None
+        else:
+            results = results[0]
+        assert results == expected, "%s gave %s not %s" % (inp, results, expected)
+
+    Q = env.get("Q")
+    assert Q.variables["a"].permission is env.get("q").find("a")[1].permission
+    assert Q.variables["b"].permission is Q.variables["get-b"].permission.set_flags(["private"])
+
+# -----------------------------------------------------------------------------
+
+def test_class_define():
+    """a variable can't be defined again in a class or anything made from 
+       it, whether it is its own or inherited"""
+
+    print "testing: class-define!"
+    env = Environment([], [], basic_environment)
+    setup = [
+        "(define A (class BaseClass))",
+        "(class-define! A 'x)",
+        "(define a (class A))",
+        "(define B (class A))",
+        "(class-define! A 'y)"]
+    list(repl(env, parse(tokenize(setup))))
+
+    for inp in ["(class-define! A 'x)", "(class-define! a 'x)",
+                "(class-define! B 'x)", "(class-define! a 'y)"]:
+        try:
+            list(repl(env, parse(tokenize([inp]))))
+        except AlreadyDefined:
+            pass
+        else:
+            assert False, "%s defined it again" % inp
+
+    assert list(repl(env, parse(tokenize(["(class-define! B 'z)"])))) == ["nil"]
+
+# -----------------------------------------------------------------------------
+
+def test_hash_keys():
+    """a vector, or a pair holding one, can't be a hash table key"""
+
+    print "testing: hash keys"
+    env = Environment([], [], basic_environment)
+    list(repl(env, parse(tokenize(["(define h (make-hash-table))"]))))
+    for inp in ["(hash-set! h (cons 1 (make-vector 2 0)) 1)",
+                "(hash-set! h (vector 1 2) 1)",
+                "(hash-ref h (vector 1 2) 0)",
+                "(hash-remove! h (list (vector 1)))"]:
+        try:
+            list(repl(env, parse(tokenize([inp]))))
+        except AssertionError, error:
+            assert "cannot be a hash table key" in str(error), error
+        else:
+            assert False, "%s did not fail" % inp
+    assert list(repl(env, parse(tokenize(["(hash-count h)"])))) == ["0"]
+
+# -----------------------------------------------------------------------------
+
+def test_autoload():
+    """every name in the library can be found, which loads all of it"""
+
+    print "testing: autoload"
+    env = Environment([], [], basic_environment)
+    assert list(repl(env, parse(tokenize(["(length '(1 2 3))"])))) == ["3"]
+    for file_name, names in library:
+        for name in names:
+            assert basic_environment.get(name) is not None, name
+    assert basic_environment.autoloads == {}
+
+# -----------------------------------------------------------------------------
+
+def test_profiler():
+    """the profiler counts each call to each procedure by name, a tail call
+       once, under every evaluator"""
+
+    print "testing: profiler"
+    for name in ["tree", "compile", "machine"]:
+        set_evaluator(name)
+        env = Environment([], [], basic_environment)
+        for inp in ["(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))",
+                    "(define (loop n) (if (= n 0) 0 (loop (- n 1))))",
+                    "(define (ping n) (if (= n 0) 0 (pong (- n 1))))",
+                    "(define (pong n) (ping n))",
+                    "(define (g) 1)",
+                    "(define (f) (g))",
+                    "(define P (class BaseClass))",
+                    "(class-define! P 'twice)",
+                    "(class-set! P 'twice (lambda (x) (* 2 x)))"]:
+            list(repl(env, parse(tokenize([inp]))))
+
+        profiler = Profiler()
+        profiler.start()
+        try:
+            results = list(repl(env, parse(tokenize(
+                ["(fib 10) (loop 20) (ping 6) (P twice 4) (f)"]))))
+        finally:
+            profiler.stop()
+        assert results == ["55", "0", "0", "8", "1"], results
+        assert sys.getprofile() is None
+
+        names = builtin_names()
+        calls = dict((procedure_name(func, names), stats.calls)
+                     for func, stats in profiler.stats.items())
+        expected = {"fib": 177, "loop": 21, "ping": 7, "pong": 6, 
+                    "P.twice": 1, "*": 1, "<": 177, "f": 1, "g": 1}
+        for proc, count in expected.items():
+            assert calls.get(proc) == count, "%s: %s called %s times not %s" % (
+                name, proc, calls.get(proc), count)
+
+        stats = profiler.stats[env.get("fib")]
+        assert 0 <= stats.self_time <= stats.total_time
+
+        port = cStringIO.StringIO()
+        profiler.report(port, names)
+        assert " fib\n" in port.getvalue()
+
+        # nothing has been called yet, i.e. it stopped while the arguments
+        # were evaluated
+        profiler.stats_for(env.get("fib")).calls = 0
+        profiler.report(cStringIO.StringIO(), names)
+
+    set_evaluator("tree")
+
+def test_sampler():
+    """the sampler sees the procedures that are running, as folded stacks"""
+
+    print "testing: sampler"
+    env = Environment([], [], basic_environment)
+    list(repl(env, parse(tokenize([
+        "(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))"]))))
+
+    sampler = Sampler(rate=1000)
+    sampler.start()
+    try:
+        # however slow the machine is, there is a sample sooner or later
+        while not sampler.samples:
+            assert list(repl(env, parse(tokenize(["(fib 12)"])))) == ["144"]
+    finally:
+        sampler.stop()
+    assert sampler.thread is None
+    # stopping it again does nothing
+    sampler.stop()
+
+    folded = sampler.folded(builtin_names())
+    assert folded and any("fib" in key.split(";") for key in folded), folded
+
+    port = cStringIO.StringIO()
+    sampler.write_folded(port, builtin_names())
+    for line in port.getvalue().splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert folded[stack] == int(count)
+
+    # stopping one that never started does nothing
+    Sampler().stop()
+    try:
+        Sampler(rate=0)
+    except AssertionError:
+        pass
+    else:
+        assert False, "a sampler was made with no rate"
+
+# -----------------------------------------------------------------------------
+
+def test_stats():
+    """the counters are enabled, read, reset and disabled from lisp, and
+       count each call to fib under every evaluator"""
+
+    print "testing: stats"
+    for name in ["tree", "compile", "machine"]:
+        set_evaluator(name)
+        env = Environment([], [], basic_environment)
+        list(repl(env, parse(tokenize([
+            "(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))",
+            "(define (counted) (begin (stats-reset!) (stats-enable!) (fib 10) (stats-disable!)))"]))))
+        try:
+            list(repl(env, parse(tokenize(["(counted)"]))))
+        finally:
+            counters.disable()
+
+        alist = evaluate(list(parse(tokenize(["(stats)"])))[0], env)
+        counts = {}
+        for pair in datatypes.to_list(alist)[:-1]:
+            assert isinstance(pair.first, datatypes.LispSymbol), alist
+            assert isinstance(pair.rest, datatypes.LispInteger), alist
+            counts[pair.first.name] = pair.rest.num
+        assert counts == dict((key, value) for key, value in counters.snapshot().items()
+                              if key != "lookup-average")
+
+        # a frame for each of the 177 calls, each looks up n at least once
+        # and fib, < and + or -
+        assert counts["environments"] >= 177, (name, counts)
+        assert counts["lookups"] >= 4 * 177, (name, counts)
+        assert counts["lookup-steps"] >= counts["lookups"], (name, counts)
+        if name != "compile":
+            assert counts["eval-LispInteger"] >= 177, (name, counts)
+
+        # nothing is counted once disabled, until enabled again
+        list(repl(env, parse(tokenize(["(fib 5)"]))))
+        assert counters.snapshot()["environments"] == counts["environments"]
+        assert list(repl(env, parse(tokenize(["(stats-reset!) (stats)"])))) == ["nil", "nil"]
+
+    set_evaluator("tree")
+
+# -----------------------------------------------------------------------------
+
+def sample_script(path, output=None, rate=200):
+    """run the script at `path` with the sampler running, the samples are 
+       written to `output` (<path>.folded by default) for flamegraph.pl"""
+
+    sampler = Sampler(rate)
+    sampler.start()
+    try:
+        with open(path) as stream:
+            read_file(stream, Environment([], [], basic_environment))
+    finally:
+        sampler.stop()
+        with open(output or path + ".folded", "w") as port:
+            sampler.write_folded(port, builtin_names())
+
+# -----------------------------------------------------------------------------
+
+def run_tests():
+    test_parse()
+    test_printer()
+    formcache.test()
+    counters.test()
+    testall("tree")
+    testall("compile")
+    testall("machine")
+    test_tail_calls()
+    test_dynamic_scope()
+    test_machine()
+    test_modules()
+    test_image()
+    test_image_size()
+    test_permissions()
+    test_class_define()
+    test_hash_keys()
+    test_autoload()
+    test_profiler()
+    test_sampler()
+    test_stats()
+
+sample_usage = "usage: python main.py --sample <script> [<output> [<rate>]]"
+
+if __name__ == "__main__" and sys.argv[1:2] == ["--sample"]:
+    args = sys.argv[2:]
+    try:
+        assert 1 <= len(args) <= 3
+        rate = float(args[2]) if args[2:] else 200
+        assert rate > 0
+    except (AssertionError, ValueError):
+        print >> sys.stderr, sample_usage
+        print >> sys.stderr, "<rate> is the samples per second, more than 0"
+        sys.exit(2)
+    sample_script(args[0], args[1] if args[1:] else None, rate)
+
+elif __name__ == "__main__":
+    run_tests()
+    main()
 
 
 # -----------------------------------------------------------------------------
@@ -1,49 +1,7 @@
 
 import re
 import string
-from datatypes import nil, true, false, mksym, cons, from_list, LispString, LispInteger
-
-class iterator_undo(object):   # undo-able iterator wrapper
-    def __init__(self, iterable):
-        super(iterator_undo, self).__init__()
-        self.iterator = iter(iterable)
-        self.stack = []
-
-    def __iter__(self):
-        return self
-
-    def next(self):
-        if self.stack:
-            # print "next: stack", self.stack
-            return self.stack.pop()
-        return self.iterator.next()  # Raises StopIteration eventually
-
-    def undo(self, item):
-        # print "undo:", item 
-        self.stack.append(item)
-
-    def peek(self):
-        item = self.next()
-        self.undo(item)
-        return item
-
-    def skip(self, num=1):
-        for i in range(num):
-            x = self.next()
-
-def test_iterator_undo():
-    it = iterator_undo([1,2,3,4,5])
-    assert list(it) == [1,2,3,4,5]
-    it = iterator_undo([1,2,3,4,5])
-    assert 1 == it.next()
-    assert it.next() == 2
-    assert it.peek() == 3
-    assert it.peek() == 3
-    assert it.next() == 3
-    assert it.next() == 4
-    assert it.next() == 5
-    
-test_iterator_undo()
+from datatypes import nil, true, false, mksym, cons, from_list, to_list, first, rest, LispPair, LispString, LispInteger, make_integer
 
 # -----------------------------------------------------------------------------
 
@@ -94,51 +52,70 @@ unquote = mksym("unquote")
 def valid_symbol_name(text):
     return set(text).issubset(normalchars)
 
-def inner_parse(tokens):
-    """take the token list from the lexer and make it into an object"""
-
-    tok = tokens.next()
+# -----------------------------------------------------------------------------
+# Parser
+#
+# The tokens are read in a loop with an explicit stack of whatever is waiting
+# for the next sexp to be finished: an `Open` list (its ')' not read yet) or
+# a quote. When a sexp is finished it is given to the top of the stack, a
+# quote is then finished too, and a sexp with nothing waiting for it is
+# yielded. Nesting is only limited by memory, and each list is only built 
+# once its ')' is read (by `from_list`, from the back).
+# -----------------------------------------------------------------------------
 
-    assert len(tok) != 0, "zero sized token"
-    assert tok != ".", "found '.' outside of pair"
-    assert tok != ")", "found ')' mismatched bracket"
+prefixes = {
+    "'" : quote,
+    "`" : quasiquote,
+    "," : unquote}
+
+def where(tok):
+    # where :: Str -> Str
+    # where the token came from, if the lexer said
+    if hasattr(tok, "line"):
+        return " at line %d column %d" % (tok.line, tok.column)
+    return ""
+
+class Open(object):
+    """A list that has been started but not finished"""
+
+    __slots__ = ("token", "items", "dotted", "tail")
+
+    def __init__(self, token):
+        self.token = token
+        self.items = []
+        self.dotted = False
+        self.tail = None
+
+    def add(self, sexp):
+        if self.dotted:
+            assert self.tail is None, "expected one sexp after a fullstop" + where(self.token)
+            self.tail = sexp
+        else:
+            self.items.append(sexp)
 
-    if tok == "'":
-        return from_list([quote, inner_parse(tokens), nil])
-    elif tok[0] == '`':
-        return from_list([quasiquote, inner_parse(tokens), nil])
-    elif tok[0] == ',':
-        return from_list([unquote, inner_parse(tokens), nil])
-    elif tok[0] == '"':
-        return LispString(tok[1:-1])
-    elif tok == "(":
-        tok = tokens.next()
-
-        if tok == ")": return nil
-
-        tokens.undo(tok)
-        tok_list = [inner_parse(tokens)]
-        while (tokens.peek() not in [")", "."]):
-            tok_list.append(inner_parse(tokens))
-        
-        tok = tokens.next()
-        if tok == ".":
-            tok_list.append(inner_parse(tokens))
-            assert tokens.next() == ")", "expected one sexp after a fullstop"
+    def close(self):
+        # close :: None -> LispBase
+        if self.dotted:
+            assert self.tail is not None, "expected one sexp after a fullstop" + where(self.token)
+            self.items.append(self.tail)
         else:
-            tok_list.append(nil)
-            assert tok == ")", "missing close bracket of pair"
+            self.items.append(nil)
+        return from_list(self.items)
 
-        return from_list(tok_list)
+def parse_atom(tok):
+    # parse_atom :: Str -> LispBase
+    if tok[0] == '"':
+        return LispString(tok[1:-1])
     elif isnumber(tok):
-        return LispInteger(int(tok))
+        return make_integer(int(tok))
     else:
         # we have a symbol 
-        assert valid_symbol_name(tok), "invalid atom in symbol '%s'" % tok
+        assert valid_symbol_name(tok), "invalid atom in symbol '%s'%s" % (tok, where(tok))
         if tok == "nil": return nil
         if tok == "true": return true
         if tok == "false": return false
-        return mksym(tok)
+        # the name is kept as a plain str, not the Token and its position
+        return mksym(str(tok))
 
 def kill_comments(iterable):
     for x in iterable:
@@ -146,9 +123,50 @@ def kill_comments(iterable):
             yield x
 
 def parse(tokens):
-    tokens = iterator_undo(kill_comments(tokens))
-    while (True):
-        yield inner_parse(tokens)
+    """take the tokens from the lexer and make each sexp into an object"""
+
+    stack = []
+    for tok in kill_comments(tokens):
+        assert len(tok) != 0, "zero sized token"
+
+        if tok == "(":
+            stack.append(Open(tok))
+            continue
+
+        elif tok in prefixes:
+            stack.append(prefixes[tok])
+            continue
+
+        elif tok == ".":
+            top = stack[-1] if stack else None
+            assert (type(top) is Open and top.items and not top.dotted), \
+                "found '.' outside of pair" + where(tok)
+            top.dotted = True
+            continue
+
+        elif tok == ")":
+            assert stack and type(stack[-1]) is Open, "found ')' mismatched bracket" + where(tok)
+            sexp = stack.pop().close()
+
+        else:
+            sexp = parse_atom(tok)
+
+        # give the sexp to whatever is waiting for it
+        while True:
+            if not stack:
+                yield sexp
+                break
+            top = stack[-1]
+            if type(top) is Open:
+                top.add(sexp)
+                break
+            # a quote
+            stack.pop()
+            sexp = from_list([top, sexp, nil])
+
+    if stack:
+        opened = [item.token for item in stack if type(item) is Open]
+        assert False, "unexpected end of input" + (where(opened[-1]) if opened else "")
 
 def test():
     print "testing: parse"
@@ -193,6 +211,23 @@ def test():
             print "result  :", res
             print "expected:", expected
 
-
-test()
-
+    # very long and very deep data is fine
+    size = 20000
+    result = list(parse(tokenize(["'(" + "x " * size + ")"])))
+    assert len(result) == 1
+    assert len(to_list(first(rest(result[0])))) == size + 1
+
+    result = list(parse(tokenize(["(" * size + "x" + ")" * size])))
+    assert len(result) == 1
+    sexp, depth = result[0], 0
+    while isinstance(sexp, LispPair):
+        sexp, depth = first(sexp), depth + 1
+    assert depth == size and sexp is mksym("x")
+
+    for test in ["(a b", "(a . )", "(a . b c)", "(. a)", "a)", "'"]:
+        try:
+            list(parse(tokenize([test])))
+        except AssertionError:
+            pass
+        else:
+            assert False, "invalid input accepted: %s" % test
@@ -0,0 +1,151 @@
+import cStringIO
+
+from datatypes import nil, LispPair, Environment, Frame, Variable
+
+# -----------------------------------------------------------------------------
+# Printer
+#
+# Writes how a value prints to a port (anything with a `write` method, i.e.
+# a file or a cStringIO) a piece at a time, so a huge result never has to be
+# built as one string.
+#
+# Lists and environments are walked with an explicit stack of what is still
+# to be written, innermost last. Each entry is either a str to write as it
+# is or a tuple:
+#
+#   (VALUE, value, level) - write `value`, nested `level` lists deep
+#   (LIST, rest, level, n) - write the rest of a list, n elements written
+#
+# Nesting is only limited by memory. Lists (and environments) nested
+# `depth` deep and the elements after the first `length` are written as
+# "..." when those limits are given.
+#
+# example:
+#   write(sexp, sys.stdout)
+#   text = to_string(sexp, depth=3, length=10)
+# -----------------------------------------------------------------------------
+
+VALUE, LIST = range(2)
+
+def write(value, port, depth=None, length=None):
+    # write :: LispBase -> Port -> Optional Int -> Optional Int -> None
+
+    out = port.write
+    todo = [(VALUE, value, 0)]
+
+    while todo:
+        item = todo.pop()
+        if type(item) is str:
+            out(item)
+            continue
+
+        if item[0] is VALUE:
+            _, value, level = item
+
+            if isinstance(value, LispPair):
+                if depth is not None and level >= depth:
+                    out("...")
+                else:
+                    out("( ")
+                    todo.append((LIST, value, level + 1, 0))
+
+            elif isinstance(value, (Environment, Frame)):
+                if depth is not None and level >= depth:
+                    out("...")
+                else:
+                    push_environment(todo, value, level + 1, length)
+
+            else:
+                # nothing else has anything nested in it
+                out(str(value))
+
+        else:
+            _, rest, level, n = item
+
+            if isinstance(rest, LispPair):
+                if length is not None and n >= length:
+                    out("... )")
+                else:
+                    todo.append((LIST, rest.rest, level, n + 1))
+                    todo.append(" ")
+                    todo.append((VALUE, rest.first, level))
+
+            elif rest is nil:
+                out(")")
+
+            else:
+                out(". ")
+                todo.append(" )")
+                todo.append((VALUE, rest, level))
+
+def push_environment(todo, env, level, length):
+    # push_environment :: [Item] -> Environment -> Int -> Optional Int -> None
+    # an environment is its bindings then those of each parent in turn:
+    #
+    #   PRINT ENV
+    #   <name> = <value>
+    #   ---
+    #   <parent> (or === for the last)
+
+    out = []
+    while env is not None:
+        if type(env) is Frame:
+            bindings = env.items()
+        else:
+            bindings = [(name, variable) for name, variable in env.variables.items()
+                        if name != "__parent__"]
+
+        out.append("PRINT ENV\n")
+        for n, (name, value) in enumerate(bindings):
+            if length is not None and n >= length:
+                out.append("...\n")
+                break
+            if isinstance(value, Variable):
+                value = value.value
+            out.append(name + " = ")
+            out.append((VALUE, value, level))
+            out.append("\n")
+        out.append("---\n")
+        env = env.parent()
+    out.append("===\n")
+
+    todo.extend(reversed(out))
+
+def to_string(value, depth=None, length=None):
+    # to_string :: LispBase -> Optional Int -> Optional Int -> Str
+    port = cStringIO.StringIO()
+    write(value, port, depth, length)
+    return port.getvalue()
+
+# -----------------------------------------------------------------------------
+
+def test():
+    print "testing: printer"
+    from lex import tokenize
+    from parse import parse
+
+    def read(text):
+        return list(parse(tokenize(text)))[0]
+
+    for text in ["nil", "a", "( a )", "( a b c )", "( a . b )", "( a b . c )",
+                 '( "a b" ( 1 ( 2 ) ) . 3 )', "( ( ( ( a ) ) ) )"]:
+        assert to_string(read(text)) == text, to_string(read(text))
+        assert str(read(text)) == text
+
+    sexp = read("(a (b (c (d))) e f g)")
+    assert to_string(sexp, depth=2) == "( a ( b ... ) e f g )"
+    assert to_string(sexp, length=2) == "( a ( b ( c ( d ) ) ) ... )"
+    assert to_string(sexp, depth=0) == "..."
+
+    # long and deep lists are fine
+    size = 20000
+    assert str(read("(" + "x " * size + ")")) == "( " + "x " * size + ")"
+    assert str(read("(" * size + ")" * size)) == "( " * (size - 1) + "nil" + " )" * (size - 1)
+
+    port = cStringIO.StringIO()
+    write(read("(1 2)"), port)
+    write(read("3"), port)
+    assert port.getvalue() == "( 1 2 )3"
+
+    env = Environment(["a"], [read("(1 2)")], Environment(["b"], [nil], None))
+    assert str(env) == "PRINT ENV\na = ( 1 2 )\n---\nPRINT ENV\nb = nil\n---\n===\n"
@@ -0,0 +1,265 @@
+import sys
+import time
+import threading
+
+from datatypes import call_stack, LispLambda
+
+# -----------------------------------------------------------------------------
+# Profiler
+#
+# Counts the calls to each procedure (LispLambda, builtin or class method)
+# and times them, while it is running. Nothing is done at all when it is
+# not: it uses `sys.setprofile`, which is only set between `start` and
+# `stop`.
+#
+# Every evaluator keeps what is being called on `call_stack`, the profiler
+# keeps its own copy of it (`entries`) and brings that up to date whenever
+# python calls or returns from anything. Whatever is on top of the stack
+# in between is what the time is counted against:
+#
+#   a longer call_stack           - the calls on top have started
+#   a shorter one                 - the calls that were on top have returned
+#   a different procedure on top  - it was tail called
+#
+# A builtin (or anything else that is not a LispLambda) is counted when it is
+# pushed. A LispLambda is counted when its call frame is made, which every
+# call to it does (see LispLambda.frame), as a tail call may push it and
+# take its caller's place with nothing in between for the profiler to see.
+# Taking a place on the stack only starts timing it again. A procedure tail
+# calling itself is timed as one long call.
+#
+# Each procedure gets:
+#
+#   calls - how many times it was called
+#   self  - the time spent in it, not counting what it called
+#   total - the time from it being called until it returned, counted once
+#           for a recursive procedure (from the outermost call)
+#
+# example:
+#   profiler = Profiler()
+#   profiler.start()
+#   ...
+#   profiler.stop()
+#   profiler.report(sys.stdout)
+#
+#   or in lisp
+#   (profile (fib 15))
+# -----------------------------------------------------------------------------
+
+timer = time.time
+frame_code = LispLambda.frame.im_func.func_code
+
+class Stats(object):
+    __slots__ = ("calls", "self_time", "total_time", "active")
+
+    def __init__(self):
+        self.calls = 0
+        self.self_time = 0.0
+        self.total_time = 0.0
+        # how many calls to it are on the stack
+        self.active = 0
+
+class Entry(object):
+    """A call on the stack, `timed` is false for calls made before the
+    profiler started"""
+    __slots__ = ("func", "start", "children", "timed")
+
+    def __init__(self, func, start, timed=True):
+        self.func = func
+        self.start = start
+        self.children = 0.0
+        self.timed = timed
+
+class Profiler(object):
+
+    def __init__(self):
+        # {LispBase: Stats}
+        self.stats = {}
+        self.entries = []
+        self.previous = None
+
+    def start(self):
+        self.entries = [Entry(func, None, False) for func in call_stack]
+        self.previous = sys.getprofile()
+        sys.setprofile(self.event)
+
+    def stop(self):
+        sys.setprofile(self.previous)
+        now = timer()
+        while self.entries:
+            self.leave(now)
+
+    def event(self, frame, event, arg):
+        # the python calls and returns around a push or pop show it soon
+        # enough, the calls to builtins (c_call, c_return, c_exception, i.e.
+        # the push) need not be looked at
+        if event[1] == "_":
+            return
+        entries = self.entries
+        if (len(call_stack) != len(entries) or
+            (entries and call_stack[-1] is not entries[-1].func)):
+            self.sync(timer())
+
+        if event == "call" and frame.f_code is frame_code:
+            # a LispLambda being called
+            self.stats_for(frame.f_locals["self"]).calls += 1
+
+    def sync(self, now):
+        # make `entries` the same as `call_stack`
+        entries = self.entries
+        depth = len(entries)
+        same = min(depth, len(call_stack))
+        while same and entries[same - 1].func is not call_stack[same - 1]:
+            same -= 1
+        while len(entries) > same:
+            self.leave(now)
+        for n in range(same, len(call_stack)):
+            # what took the place of a call on the stack was tail called,
+            # which only a LispLambda can be
+            func = call_stack[n]
+            self.enter(func, now, n >= depth and type(func) is not LispLambda)
+
+    def stats_for(self, func):
+        # stats_for :: LispBase -> Stats
+        stats = self.stats.get(func)
+        if stats is None:
+            stats = self.stats[func] = Stats()
+        return stats
+
+    def enter(self, func, now, counted=True):
+        stats = self.stats_for(func)
+        if counted:
+            stats.calls += 1
+        stats.active += 1
+        self.entries.append(Entry(func, now))
+
+    def leave(self, now):
+        entry = self.entries.pop()
+        if not entry.timed:
+            return
+        taken = now - entry.start
+        stats = self.stats[entry.func]
+        stats.self_time += taken - entry.children
+        stats.active -= 1
+        if stats.active == 0:
+            stats.total_time += taken
+        if self.entries:
+            self.entries[-1].children += taken
+
+    def report(self, port, names=None, limit=None):
+        # report :: Port -> Optional {Int: Str} -> Optional Int -> None
+        # the procedures that took longest first, `names` has the name
+        # of each builtin by id
+        names = names or {}
+        rows = sorted(self.stats.items(), key=lambda item: -item[1].self_time)
+        if limit is not None:
+            rows = rows[:limit]
+
+        port.write("%10s %10s %10s %10s  %s\n" % (
+            "calls", "self", "total", "per call", "procedure"))
+        for func, stats in rows:
+            # a procedure can be on the stack without having been called yet
+            # (i.e. while its arguments were evaluated when it stopped)
+            per_call = stats.total_time / stats.calls if stats.calls else 0.0
+            port.write("%10d %10.6f %10.6f %10.6f  %s\n" % (
+                stats.calls, stats.self_time, stats.total_time,
+                per_call, procedure_name(func, names)))
+
+def procedure_name(func, names):
+    # procedure_name :: LispBase -> {Int: Str} -> Str
+    name = names.get(id(func))
+    if name is None:
+        name = getattr(func, "name", None)
+    if name is None:
+        name = str(func)
+    return name
+
+def profile(thunk, port=None, names=None):
+    # profile :: (None -> a) -> Optional Port -> Optional {Int: Str} -> a
+    # call `thunk` with the profiler running, then report on it
+    profiler = Profiler()
+    profiler.start()
+    try:
+        return thunk()
+    finally:
+        profiler.stop()
+        profiler.report(port or sys.stdout, names)
+
+# -----------------------------------------------------------------------------
+# Sampler
+#
+# Costs much less than the profiler, and does not change how long anything
+# takes relative to anything else, by not looking at every call: a thread
+# copies `call_stack` `rate` times a second and counts how often each stack
+# was seen. The main thread is only held up for as long as the copy takes.
+#
+# The counts are written as folded stacks, the outermost call first, one
+# line per stack:
+#
+#   main;fib;fib;+ 12
+#
+# which is what flamegraph.pl (and speedscope, inferno...) read.
+#
+# example:
+#   sampler = Sampler(rate=1000)
+#   sampler.start()
+#   ...
+#   sampler.stop()
+#   sampler.write_folded(port)
+#
+#   or from the command line
+#   python main.py --sample script.scm script.folded 1000
+# -----------------------------------------------------------------------------
+
+class Sampler(object):
+
+    def __init__(self, rate=200):
+        # rate :: Float, samples per second
+        assert rate > 0, "the sample rate must be more than 0, not %s" % rate
+        self.interval = 1.0 / rate
+        # {(LispBase): Int}
+        self.samples = {}
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="sampler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        # does nothing unless it was started
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            self.sample()
+
+    def sample(self):
+        # a copy of a list is made while holding the GIL so the evaluator
+        # can't change it half way through
+        stack = tuple(call_stack)
+        if stack:
+            self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def folded(self, names=None):
+        # folded :: Optional {Int: Str} -> {Str: Int}
+        # the count of each stack by its names, different procedures with 
+        # the same name are counted together
+        names = names or {}
+        result = {}
+        for stack, count in self.samples.items():
+            key = ";".join(procedure_name(func, names).replace(";", ":")
+                           for func in stack)
+            result[key] = result.get(key, 0) + count
+        return result
+
+    def write_folded(self, port, names=None):
+        # write_folded :: Port -> Optional {Int: Str} -> None
+        for key, count in sorted(self.folded(names).items()):
+            port.write("%s %d\n" % (key, count))